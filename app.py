@@ -1,5 +1,18 @@
 import streamlit as st
 
+from utils import (
+    count_rerun,
+    set_current_page,
+    show_memory_panel,
+    show_timing_panel,
+    start_dataset_refresher,
+    start_session_prefetch,
+    start_warehouse_warmup,
+    start_write_queue_flusher,
+    timed_span,
+    track_session_memory,
+)
+
 pages = {
     "Pages": [
         st.Page("./views/ww-trends.py", title="Respiratory Virus Trends", icon="🚰", default=True),
@@ -10,9 +23,26 @@ pages = {
     ],
 }
 
+# Wake the SQL warehouse in the background the first time the app runs
+start_warehouse_warmup()
+# Optionally refresh the cached datasets incrementally in the background
+start_dataset_refresher()
+# Optionally load every page's data concurrently when a session starts
+start_session_prefetch()
+# Write the queued editor submissions to the warehouse in the background
+start_write_queue_flusher()
+
 pg = st.navigation(
     pages,
     expanded=True,
 )
 
-pg.run()
+# Keep idle sessions within the memory budget
+track_session_memory()
+# Attribute this rerun's queries and spans to the selected page
+set_current_page(pg.title)
+count_rerun("page")
+with timed_span("rerun"):
+    pg.run()
+show_timing_panel()
+show_memory_panel()
@@ -0,0 +1,399 @@
+"""Local DuckDB backend that stands in for the Databricks SQL warehouse.
+
+Set ``DB_BACKEND=local`` to make ``utils.get_cursor`` serve every query
+template from the DuckDB file at ``LOCAL_DB_PATH``. The file is seeded with
+synthetic data by running this module:
+
+    python local_db.py --sites 40 --measures 4
+
+DuckDB is only needed for local runs, so it is not part of requirements.txt
+(``pip install duckdb``).
+"""
+
+import argparse
+from datetime import date, datetime, timedelta
+import os
+import random
+import re
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "local.duckdb")
+
+PROVINCES = {
+    "Alberta": "AB",
+    "British Columbia": "BC",
+    "Manitoba": "MB",
+    "New Brunswick": "NB",
+    "Newfoundland and Labrador": "NL",
+    "Nova Scotia": "NS",
+    "Ontario": "ON",
+    "Prince Edward Island": "PE",
+    "Quebec": "QC",
+    "Saskatchewan": "SK",
+    "Northwest Territories": "NT",
+    "Nunavut": "NU",
+    "Yukon": "YT",
+}
+MEASURES = ["covN2", "rsv", "fluA", "fluB"]
+VIRAL_ACTIVITY_LEVELS = ["High", "Moderate", "Low", "Non-detect", "NA1", "NA2"]
+G2R_LABELS = [
+    "Consistent Detection",
+    "Intermittent Detection",
+    "No Detection",
+    "No Recent Data",
+]
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "The local database backend requires DuckDB: pip install duckdb"
+        ) from e
+    return duckdb
+
+
+# Rewrites from the Databricks SQL used by the query templates to DuckDB SQL
+PARAM_PATTERN = re.compile(r"%\((\w+)\)s")
+INLINE_VALUES_PATTERN = re.compile(r"FROM VALUES (.*?) AS (\w+)\(", re.S)
+DATE_ARITHMETIC_PATTERN = re.compile(r"DATE_(ADD|SUB)\((.+?), (\d+)\)")
+QUALIFIED_SET_PATTERN = re.compile(r"(UPDATE SET\s+)\w+\.")
+
+
+def translate_query(query: str) -> str:
+    query = PARAM_PATTERN.sub(r"$\1", query)
+    query = query.replace("CURRENT_DATE()", "CURRENT_DATE")
+    query = INLINE_VALUES_PATTERN.sub(r"FROM (VALUES \1) AS \2(", query)
+    query = DATE_ARITHMETIC_PATTERN.sub(
+        lambda m: f"({m.group(2)} {'+' if m.group(1) == 'ADD' else '-'} "
+        f"INTERVAL {m.group(3)} DAY)",
+        query,
+    )
+    return QUALIFIED_SET_PATTERN.sub(r"\1", query)
+
+
+def to_python(value):
+    # DuckDB cannot bind numpy scalars, so unwrap them
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Row(tuple):
+    """A result row that behaves like databricks.sql's Row."""
+
+    def __new__(cls, fields: list[str], values: tuple):
+        row = super().__new__(cls, values)
+        row._fields = fields
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return super().__getitem__(self._fields.index(key))
+        return super().__getitem__(key)
+
+    def asDict(self) -> dict:
+        return dict(zip(self._fields, self))
+
+
+class LocalCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._result = None
+        self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, query: str, parameters: dict = None):
+        query = translate_query(query)
+        # Only bind the parameters the query actually uses
+        names = set(re.findall(r"\$(\w+)", query))
+        params = {
+            name: to_python(value)
+            for name, value in (parameters or {}).items()
+            if name in names
+        }
+        self._reader = None
+        self._result = self._conn.execute(query, params)
+        return self
+
+    @property
+    def description(self):
+        return self._result.description
+
+    def _fields(self) -> list[str]:
+        return [column[0] for column in self._result.description]
+
+    def fetchall(self) -> list[Row]:
+        fields = self._fields()
+        return [Row(fields, values) for values in self._result.fetchall()]
+
+    def fetchone(self) -> Row:
+        values = self._result.fetchone()
+        return None if values is None else Row(self._fields(), values)
+
+    def fetchmany(self, size: int) -> list[Row]:
+        fields = self._fields()
+        return [Row(fields, values) for values in self._result.fetchmany(size)]
+
+    def fetchall_arrow(self) -> pa.Table:
+        if self._reader is not None:
+            return self._reader.read_all()
+        return self._result.fetch_arrow_table()
+
+    def fetchmany_arrow(self, size: int) -> pa.Table:
+        if self._reader is None:
+            self._reader = self._result.fetch_record_batch(size)
+        try:
+            return pa.Table.from_batches([self._reader.read_next_batch()])
+        except StopIteration:
+            return self._reader.schema.empty_table()
+
+    def cancel(self):
+        self._conn.interrupt()
+
+    def close(self):
+        self._result = None
+        self._reader = None
+
+
+class LocalConnection:
+    def __init__(self, path: str):
+        self._conn = import_duckdb().connect(path)
+        self.open = True
+
+    def cursor(self) -> LocalCursor:
+        # Every cursor gets its own DuckDB cursor so they can run side by side
+        return LocalCursor(self._conn.cursor())
+
+    def close(self):
+        self._conn.close()
+        self.open = False
+
+
+def connect(path: str = LOCAL_DB_PATH) -> LocalConnection:
+    return LocalConnection(path)
+
+
+def ww_trends_row(
+    rng: random.Random,
+    measure: str,
+    location: str,
+    grouping: str,
+    city: str = "",
+    province: str = "",
+) -> dict:
+    return {
+        "Location": location,
+        "measure": measure,
+        "latestTrends": rng.choice(["Increasing", "Decreasing", "No change"]),
+        "LatestLevel": rng.choice(["High", "Moderate", "Low"]),
+        "Grouping": grouping,
+        "City": city,
+        "Province": province,
+        "Viral_Activity_Level": rng.choice(VIRAL_ACTIVITY_LEVELS),
+    }
+
+
+def get_measures(n_measures: int) -> list[str]:
+    # The real measures, followed by synthetic ones when more are asked for
+    synthetic = [f"measure{i}" for i in range(len(MEASURES), n_measures)]
+    return (MEASURES + synthetic)[:n_measures]
+
+
+def generate_datasets(
+    n_sites: int = 40,
+    n_days: int = 120,
+    seed: int = 0,
+    n_measures: int = len(MEASURES),
+):
+    """Generate synthetic versions of every table used by the app.
+
+    Returns a dict of DataFrames keyed by the table's environment variable
+    name (e.g. "WW_TRENDS_TABLE"). The data scales with ``n_sites`` and
+    ``n_measures``.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    provinces = list(PROVINCES)
+    measures = get_measures(n_measures)
+
+    # Sites are spread over cities, and only every other city has its own row
+    sites = []
+    for i in range(n_sites):
+        province = provinces[i % len(provinces)]
+        city = f"{PROVINCES[province]} City {i // (2 * len(provinces))}"
+        sites.append(
+            {
+                "siteID": f"site{i:05d}",
+                "name": f"{city} Site {i}",
+                "City": city,
+                "Province": province,
+                "healthReg": f"{PROVINCES[province]} Health Region {i % 5}",
+                "datasetID": f"dataset{i % 10}",
+            }
+        )
+    cities = {(site["City"], site["Province"]) for site in sites}
+
+    ww_trends = []
+    for measure in measures:
+        ww_trends.append(ww_trends_row(rng, measure, "Canada", "Canada"))
+        for province in provinces:
+            ww_trends.append(
+                ww_trends_row(rng, measure, province, "Province", province=province)
+            )
+        for i, (city, province) in enumerate(sorted(cities)):
+            if i % 2 == 0:
+                ww_trends.append(
+                    ww_trends_row(rng, measure, city, "City", city, province)
+                )
+        for site in sites:
+            ww_trends.append(
+                ww_trends_row(
+                    rng, measure, site["name"], "Site", site["City"], site["Province"]
+                )
+            )
+
+    mpox = []
+    for site in sites:
+        for week in range(1, 9):
+            week_start = today - timedelta(weeks=9 - week)
+            mpox.append(
+                {
+                    "Location": site["name"],
+                    "EpiYear": float(week_start.isocalendar()[0]),
+                    "EpiWeek": float(week_start.isocalendar()[1]),
+                    "Week_start": week_start,
+                    "g2r_label": rng.choice(G2R_LABELS),
+                }
+            )
+
+    allsites = []
+    latest_measures = []
+    large_jumps = []
+    for site in sites:
+        for measure in measures:
+            values = [
+                (today - timedelta(days=n_days - day), rng.lognormvariate(3, 1))
+                for day in range(0, n_days, 3)
+            ]
+            allsites.extend(
+                {
+                    "siteID": site["siteID"],
+                    "measure": measure,
+                    "collDT": coll_dt,
+                    "valavg": value,
+                }
+                for coll_dt, value in values
+            )
+            (previous_dt, previous_obs), (latest_dt, latest_obs) = values[-2:]
+            latest_measures.append(
+                {
+                    "name": site["name"],
+                    "healthReg": site["healthReg"],
+                    "siteID": site["siteID"],
+                    "datasetID": site["datasetID"],
+                    "measure": measure,
+                    "previousObs": previous_obs,
+                    "latestObs": latest_obs,
+                    "previousObsDT": datetime.combine(previous_dt, datetime.min.time()),
+                    "latestObsDT": datetime.combine(latest_dt, datetime.min.time()),
+                    "previousReportDT": datetime.combine(previous_dt, datetime.min.time())
+                    + timedelta(days=2),
+                    "latestReportDT": datetime.combine(latest_dt, datetime.min.time())
+                    + timedelta(days=2),
+                    "sampleID_previous": str(uuid.UUID(int=rng.getrandbits(128))),
+                    "sampleID_latest": str(uuid.UUID(int=rng.getrandbits(128))),
+                }
+            )
+            # Flag a few jumps within the last 30 days
+            for (prev_dt, prev_obs), (jump_dt, jump_obs) in zip(values, values[1:]):
+                if (today - jump_dt).days < 30 and rng.random() < 0.1:
+                    large_jumps.append(
+                        {
+                            "siteID": site["siteID"],
+                            "datasetID": site["datasetID"],
+                            "measure": measure,
+                            "previousObs": prev_obs,
+                            "latestObs": jump_obs * 20,
+                            "previousObsDT": datetime.combine(prev_dt, datetime.min.time()),
+                            "latestObsDT": datetime.combine(jump_dt, datetime.min.time()),
+                            "alertType": rng.choice(["largeJump", "newMax"]),
+                            "actionItem": "keep",
+                        }
+                    )
+
+    logs = []
+    for i in range(n_sites * 5):
+        site = rng.choice(sites)
+        logs.append(
+            {
+                "LogID": str(uuid.UUID(int=rng.getrandbits(128))),
+                "User": rng.choice(["dev", "analyst1", "analyst2"]),
+                "Time": datetime.now().replace(microsecond=0) - timedelta(hours=i),
+                "Page": "Water Wastewater Trends",
+                "Location": site["name"],
+                "SiteID": "N/A",
+                "Measure": rng.choice(measures),
+                "EpiWeek": "N/A",
+                "EpiYear": "N/A",
+                "ChangedColumn": "Viral_Activity_Level",
+                "OldValue": rng.choice(VIRAL_ACTIVITY_LEVELS),
+                "NewValue": rng.choice(VIRAL_ACTIVITY_LEVELS),
+            }
+        )
+
+    return {
+        "WW_TRENDS_TABLE": pd.DataFrame(ww_trends),
+        "MPOX_TABLE": pd.DataFrame(mpox),
+        "LARGE_JUMPS_TABLE": pd.DataFrame(large_jumps),
+        "LATEST_MEASURES_TABLE": pd.DataFrame(latest_measures),
+        "ALLSITES_TABLE": pd.DataFrame(allsites),
+        "LOGS_TABLE": pd.DataFrame(logs),
+    }
+
+
+def seed_database(
+    path: str = LOCAL_DB_PATH,
+    n_sites: int = 40,
+    seed: int = 0,
+    n_measures: int = len(MEASURES),
+):
+    # (Re)create every table named in the environment with synthetic data
+    conn = import_duckdb().connect(path)
+    try:
+        datasets = generate_datasets(n_sites=n_sites, seed=seed, n_measures=n_measures)
+        for env_name, df in datasets.items():
+            table = os.getenv(env_name)
+            if not table:
+                raise ValueError(f"{env_name} must be set to seed the local database")
+            conn.register("seed_df", df)
+            conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM seed_df")
+            conn.unregister("seed_df")
+            print(f"Seeded {table} with {len(df)} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", default=LOCAL_DB_PATH)
+    parser.add_argument("--sites", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--measures", type=int, default=len(MEASURES))
+    args = parser.parse_args()
+    seed_database(
+        args.path, n_sites=args.sites, seed=args.seed, n_measures=args.measures
+    )
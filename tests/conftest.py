@@ -0,0 +1,68 @@
+import importlib.util
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The pages check the user's edit rights when they are imported
+os.environ.setdefault("DEVELOPMENT", "TRUE")
+
+# The functions under test are called outside of a Streamlit script run
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(
+    logging.ERROR
+)
+logging.getLogger("streamlit.runtime.caching.cache_data_api").setLevel(logging.ERROR)
+
+
+def pytest_addoption(parser):
+    # Sizes of the synthetic data in tests/test_benchmarks.py
+    parser.addoption(
+        "--scale",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="multiples of today's number of sites to benchmark at (e.g. 1 10 100)",
+    )
+    parser.addoption(
+        "--measures",
+        type=int,
+        nargs="+",
+        default=[4],
+        help="numbers of measures per site to benchmark at (e.g. 4 16)",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    # One run of each benchmark per --scale and --measures value
+    if "scale" in metafunc.fixturenames:
+        metafunc.parametrize(
+            "scale", metafunc.config.getoption("scale"), scope="session"
+        )
+    if "n_measures" in metafunc.fixturenames:
+        metafunc.parametrize(
+            "n_measures", metafunc.config.getoption("measures"), scope="session"
+        )
+
+
+def load_page(name: str):
+    # Import views/<name>.py as a module; only its functions and constants are
+    # defined, the page itself is rendered by Streamlit alone
+    path = os.path.join(ROOT, "views", f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def ww_trends():
+    return load_page("ww-trends")
+
+
+@pytest.fixture(scope="session")
+def large_jumps():
+    return load_page("large-jumps")
@@ -0,0 +1,140 @@
+"""Benchmarks for the data-shaping functions on the pages' rerun paths.
+
+Every benchmark runs on synthetic data from local_db.generate_datasets, once
+per --scale (multiples of today's number of sites) and --measures value:
+
+    python -m pytest tests/test_benchmarks.py --scale 1 10 100 --benchmark-save=baseline
+    python -m pytest tests/test_benchmarks.py --scale 1 10 100 \\
+        --benchmark-compare --benchmark-compare-fail=median:20%
+
+Saved runs live in .benchmarks/. The compare run fails if any benchmark got
+more than 20% slower than the latest saved run.
+"""
+
+import pandas as pd
+import plotly.io
+import plotly.tools
+import pytest
+
+from local_db import generate_datasets, get_measures
+from utils import (
+    DATASET_SCHEMAS,
+    FETCH_LATEST_MEASURES_QUERY,
+    FETCH_WW_TRENDS_QUERY,
+    build_change_set,
+    compact_dtypes,
+    filter_sites_and_measures,
+    get_changed_indices,
+)
+
+# Roughly the number of sites reporting today
+BASE_SITES = 40
+
+
+@pytest.fixture(scope="session")
+def datasets(scale: int, n_measures: int) -> dict[str, pd.DataFrame]:
+    datasets = generate_datasets(n_sites=BASE_SITES * scale, n_measures=n_measures)
+    # The pages work on the compact frames of the dataset cache
+    datasets["WW_TRENDS_TABLE"] = compact_dtypes(
+        datasets["WW_TRENDS_TABLE"], DATASET_SCHEMAS[FETCH_WW_TRENDS_QUERY]
+    )
+    return datasets
+
+
+def get_jump_history(allsites: pd.DataFrame, jump: pd.Series) -> pd.DataFrame:
+    # The same shape fetch_jump_histories returns for a single jump
+    site = allsites[
+        (allsites["siteID"] == jump["siteID"]) & (allsites["measure"] == jump["measure"])
+    ].sort_values("collDT")
+    before = site[site["collDT"] < jump["previousObsDT"].date()].tail(4)
+    after = site[site["collDT"] > jump["latestObsDT"].date()].head(1)
+    return pd.concat([before.assign(position="before"), after.assign(position="after")])
+
+
+def test_get_missing_PT(benchmark, ww_trends, datasets):
+    benchmark(ww_trends.get_missing_PT, datasets["WW_TRENDS_TABLE"], "covN2")
+
+
+def test_build_sunburst_data(benchmark, ww_trends, datasets):
+    benchmark(ww_trends.build_sunburst_data, datasets["WW_TRENDS_TABLE"], "covN2")
+
+
+def test_create_sunburst_graph(benchmark, ww_trends, datasets):
+    benchmark(ww_trends.create_sunburst_graph, datasets["WW_TRENDS_TABLE"], "covN2")
+
+
+def test_get_sunburst_figures(benchmark, ww_trends, datasets):
+    # A new dataset version: every measure's figure is built
+    benchmark.pedantic(
+        ww_trends.get_sunburst_figures,
+        args=(0, datasets["WW_TRENDS_TABLE"]),
+        setup=ww_trends.get_sunburst_figures.clear,
+        rounds=5,
+    )
+
+
+def test_get_sunburst_figures_cached(benchmark, ww_trends, datasets):
+    # Switching the measure of an unchanged dataset
+    ww_trends.get_sunburst_figures.clear()
+    ww_trends.get_sunburst_figures(0, datasets["WW_TRENDS_TABLE"])
+    benchmark(ww_trends.get_sunburst_figures, 0, datasets["WW_TRENDS_TABLE"])
+
+
+def test_render_sunburst_figure(benchmark, ww_trends, datasets):
+    # What st.plotly_chart() still does with a cached figure on every rerun
+    figure = ww_trends.create_sunburst_graph(datasets["WW_TRENDS_TABLE"], "covN2")
+
+    def render():
+        figure_or_data = plotly.tools.return_figure_from_figure_or_data(figure, True)
+        return plotly.io.to_json(figure_or_data, validate=False)
+
+    benchmark(render)
+
+
+def test_build_change_set(benchmark, datasets):
+    old_rows = datasets["WW_TRENDS_TABLE"].head(100)
+    new_rows = old_rows.assign(Viral_Activity_Level="High")
+    benchmark(build_change_set, old_rows, new_rows, "Water Wastewater Trends")
+
+
+def test_get_changed_indices(benchmark, datasets):
+    old_rows = datasets["WW_TRENDS_TABLE"].head(100)
+    new_rows = old_rows.assign(Viral_Activity_Level="High")
+    benchmark(get_changed_indices, old_rows, new_rows, ["Viral_Activity_Level"])
+
+
+@pytest.mark.parametrize("n_sites", [None, 25], ids=["all sites", "25 sites"])
+def test_filter_ww_trends(benchmark, datasets, n_measures, n_sites):
+    df = datasets["WW_TRENDS_TABLE"]
+    sites = ["All Sites"] if n_sites is None else list(df["Location"].unique()[:n_sites])
+    benchmark(
+        filter_sites_and_measures, df, "Location", sites, get_measures(n_measures)
+    )
+
+
+def test_filter_latest_measures(benchmark, datasets, n_measures):
+    df = datasets["LATEST_MEASURES_TABLE"]
+    sites = list(df["name"].unique()[:25])
+    measures = get_measures(n_measures)[:2]
+    benchmark(filter_sites_and_measures, df, "name", sites, measures)
+
+
+def test_compact_dtypes(benchmark, datasets):
+    df = datasets["LATEST_MEASURES_TABLE"]
+    benchmark(compact_dtypes, df, DATASET_SCHEMAS[FETCH_LATEST_MEASURES_QUERY])
+
+
+def test_create_jump_plots(benchmark, large_jumps, datasets):
+    jumps = datasets["LARGE_JUMPS_TABLE"].head(30)
+    histories = [
+        get_jump_history(datasets["ALLSITES_TABLE"], jump)
+        for _, jump in jumps.iterrows()
+    ]
+
+    def create_jump_plots():
+        return [
+            large_jumps.create_jump_plot(jump, True, history)
+            for (_, jump), history in zip(jumps.iterrows(), histories)
+        ]
+
+    benchmark(create_jump_plots)
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import utils
+from local_db import generate_datasets
+from utils import (
+    FETCH_MPOX_QUERY,
+    CachedDataset,
+    fetch_versioned_dataset,
+    get_loaded_datasets,
+    is_dataset_live,
+    load_dataset,
+    save_snapshot,
+)
+
+
+@pytest.fixture
+def slow_warehouse(monkeypatch, tmp_path):
+    # Snapshots in tmp_path and a warehouse read that waits until the event is set
+    monkeypatch.setattr(utils, "SNAPSHOT_DIR", str(tmp_path))
+    released = threading.Event()
+    live_df = generate_datasets(n_sites=2)["MPOX_TABLE"]
+
+    def read_dataset(query: str) -> tuple[pd.DataFrame, int]:
+        released.wait(timeout=10)
+        return live_df, 1
+
+    monkeypatch.setattr(utils, "read_dataset", read_dataset)
+    load_dataset.clear()
+    get_loaded_datasets().clear()
+    yield released, live_df
+    released.set()
+    load_dataset.clear()
+    get_loaded_datasets().clear()
+
+
+def wait_for_frame(query: str, df: pd.DataFrame):
+    deadline = time.monotonic() + 10
+    while get_loaded_datasets()[query].df is not df:
+        assert time.monotonic() < deadline, "the dataset was never revalidated"
+        time.sleep(0.01)
+
+
+def test_snapshot_served_during_revalidation(slow_warehouse):
+    released, live_df = slow_warehouse
+    snapshot_df = generate_datasets(n_sites=1)["MPOX_TABLE"]
+    save_snapshot(FETCH_MPOX_QUERY, CachedDataset(snapshot_df, None))
+
+    start = time.monotonic()
+    dataset = load_dataset(FETCH_MPOX_QUERY)
+    df, version = fetch_versioned_dataset(FETCH_MPOX_QUERY)
+    assert time.monotonic() - start < 5
+    assert not dataset.live
+    assert not is_dataset_live(FETCH_MPOX_QUERY)
+    assert len(df) == len(snapshot_df)
+
+    released.set()
+    wait_for_frame(FETCH_MPOX_QUERY, live_df)
+    assert is_dataset_live(FETCH_MPOX_QUERY)
+    assert fetch_versioned_dataset(FETCH_MPOX_QUERY)[1] > version
+
+
+def test_expired_dataset_served_during_revalidation(slow_warehouse):
+    released, live_df = slow_warehouse
+    previous = CachedDataset(generate_datasets(n_sites=1)["MPOX_TABLE"], None)
+    get_loaded_datasets()[FETCH_MPOX_QUERY] = previous
+
+    start = time.monotonic()
+    dataset = load_dataset(FETCH_MPOX_QUERY)
+    assert time.monotonic() - start < 5
+    # Still editable: it was live when it expired
+    assert dataset is previous
+    assert dataset.live
+
+    released.set()
+    wait_for_frame(FETCH_MPOX_QUERY, live_df)
@@ -0,0 +1,74 @@
+import pandas as pd
+import pytest
+
+from local_db import MEASURES, generate_datasets
+from utils import DATASET_SCHEMAS, FETCH_WW_TRENDS_QUERY, compact_dtypes
+
+
+def build_sunburst_data_iterrows(
+    df: pd.DataFrame, measure: str, prov_to_abbr: dict[str, str]
+) -> pd.DataFrame:
+    # The row-by-row implementation build_sunburst_data() replaced
+    df = df[df["measure"] == measure]
+
+    labels = []
+    parents = []
+    values = []
+
+    site_only_mask = (
+        # First find all Site rows
+        (df["Grouping"] == "Site")
+        &
+        # Then exclude locations that also have City records
+        ~df["City"].isin(df[df["Grouping"] == "City"]["Location"].unique())
+    )
+
+    for i, row in df.iterrows():
+        viral_activity = row["Viral_Activity_Level"]
+        if pd.isna(viral_activity):
+            viral_activity = "NA1"
+
+        values.append(viral_activity)
+        if row["Grouping"] == "Site":
+            labels.append(row["Location"])
+            parent = prov_to_abbr[row["Province"]] if site_only_mask[i] else row["City"]
+            parents.append(parent)
+        if row["Grouping"] == "City":
+            labels.append(row["City"])
+            parents.append(prov_to_abbr[row["Province"]])
+        if row["Grouping"] == "Province":
+            labels.append(prov_to_abbr[row["Province"]])
+            parents.append("Canada")
+        if row["Grouping"] == "Canada":
+            labels.append("Canada")
+            parents.append("")
+
+    return pd.DataFrame({"labels": labels, "parents": parents, "values": values})
+
+
+def get_ww_trends(n_sites: int, compact: bool) -> pd.DataFrame:
+    df = generate_datasets(n_sites=n_sites)["WW_TRENDS_TABLE"]
+    # Rows without a level are drawn as NA1
+    missing = df.sample(frac=0.05, random_state=0).index
+    df.loc[missing, "Viral_Activity_Level"] = None
+    if compact:
+        # As stored in the dataset cache
+        df = compact_dtypes(df, DATASET_SCHEMAS[FETCH_WW_TRENDS_QUERY])
+    return df
+
+
+@pytest.mark.parametrize("compact", [False, True], ids=["raw", "compact"])
+@pytest.mark.parametrize("n_sites", [1, 40, 400, 2000])
+def test_build_sunburst_data_matches_iterrows(ww_trends, n_sites, compact):
+    df = get_ww_trends(n_sites, compact)
+    for measure in MEASURES:
+        expected = build_sunburst_data_iterrows(df, measure, ww_trends.prov_to_abbr)
+        actual = ww_trends.build_sunburst_data(df, measure)
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_build_sunburst_data_ignores_other_measures(ww_trends):
+    df = get_ww_trends(40, compact=False)
+    data = ww_trends.build_sunburst_data(df, "rsv")
+    assert len(data) == (df["measure"] == "rsv").sum()
+    assert (data["labels"] == "Canada").sum() == 1
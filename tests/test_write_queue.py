@@ -0,0 +1,47 @@
+import sqlite3
+
+import pytest
+
+from utils import WRITE_APPLIED, WRITE_PENDING, WriteQueue
+
+
+@pytest.fixture
+def queue_path(tmp_path) -> str:
+    path = str(tmp_path / "write_queue.sqlite3")
+    queue = WriteQueue(path)
+    for i in range(3):
+        queue.enqueue(f"key-{i}", "mpox", "editor", [{"g2r_label": "Low"}], [])
+    return path
+
+
+def get_statuses(path: str) -> list[str]:
+    with sqlite3.connect(path) as conn:
+        return [row[0] for row in conn.execute("SELECT status FROM submissions")]
+
+
+def test_flushers_never_claim_the_same_submission(queue_path):
+    first, second = WriteQueue(queue_path), WriteQueue(queue_path)
+    claimed = first.get_due(2)
+    assert [s["id"] for s in claimed] == [1, 2]
+    # The page's next submission waits for the claimed ones
+    assert second.get_due(10) == []
+
+    # A flusher can only settle its own claims
+    second.mark_applied([dict(s, claimed_by="other") for s in claimed])
+    assert WRITE_APPLIED not in get_statuses(queue_path)
+    first.mark_applied(claimed)
+    assert [s["id"] for s in second.get_due(10)] == [3]
+
+
+def test_expired_claim_is_claimed_again(queue_path):
+    queue = WriteQueue(queue_path)
+    claimed = queue.get_due(10)
+    with sqlite3.connect(queue_path) as conn:
+        conn.execute("UPDATE submissions SET lease_expires_at = 0")
+    reclaimed = queue.get_due(10)
+    assert [s["id"] for s in reclaimed] == [s["id"] for s in claimed]
+
+    # The first claim is gone: its flusher can no longer settle the submissions
+    queue.release(claimed)
+    queue.record_failure(claimed[0], "too late")
+    assert WRITE_PENDING not in get_statuses(queue_path)
@@ -1,11 +1,31 @@
-from datetime import datetime
+from cachetools import LRUCache
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime
+import atexit
+import functools
+import hashlib
 import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
 from dotenv import load_dotenv
 from databricks import sql
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner_utils.script_requests import ScriptRequestType
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -16,6 +36,110 @@ LOGS_TABLE = os.getenv("LOGS_TABLE")
 LATEST_MEASURES_TABLE = os.getenv("LATEST_MEASURES_TABLE")
 ALLSITES_TABLE = os.getenv("ALLSITES_TABLE")
 
+# "databricks" (default) or "local" to serve every query from the DuckDB file
+# at LOCAL_DB_PATH instead (see local_db.py)
+DB_BACKEND = os.getenv("DB_BACKEND", "databricks")
+
+# Process-wide dataset cache settings, shared by every session
+DATASET_CACHE_TTL = int(os.getenv("DATASET_CACHE_TTL", 3600))
+DATASET_CACHE_MAX_ENTRIES = int(os.getenv("DATASET_CACHE_MAX_ENTRIES", 16))
+
+# Process-wide connection pool settings
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 8))
+DB_POOL_IDLE_TIMEOUT = int(os.getenv("DB_POOL_IDLE_TIMEOUT", 600))
+DB_POOL_ACQUIRE_TIMEOUT = int(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", 300))
+# Connections idle for longer than this are pinged before being handed out again
+DB_POOL_LIVENESS_INTERVAL = 30
+
+# Warehouse calls (an execute or fetch) running longer than this many seconds
+# are cancelled (0 = no limit). Checked every QUERY_WATCHDOG_INTERVAL seconds.
+QUERY_TIMEOUT = int(os.getenv("QUERY_TIMEOUT", 600))
+QUERY_WATCHDOG_INTERVAL = 1
+
+# Maximum number of rows written by a single batched MERGE/INSERT statement
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 100))
+
+# Number of rows pulled per Arrow batch when streaming large results
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", 100_000))
+
+# Maximum number of large-jump histories kept in the shared LRU cache
+JUMP_HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("JUMP_HISTORY_CACHE_MAX_ENTRIES", 2048))
+
+# Number of log entries shown per page on the admin page
+LOG_PAGE_SIZE = int(os.getenv("LOG_PAGE_SIZE", 100))
+
+# Optional keep-warm schedule, e.g. "8-18" pings the warehouse every
+# WAREHOUSE_KEEP_WARM_INTERVAL seconds between 8:00 and 18:00 on weekdays
+WAREHOUSE_KEEP_WARM_HOURS = os.getenv("WAREHOUSE_KEEP_WARM_HOURS")
+WAREHOUSE_KEEP_WARM_INTERVAL = int(os.getenv("WAREHOUSE_KEEP_WARM_INTERVAL", 600))
+
+# Opt-in: load every page's dataset concurrently when a session starts
+PREFETCH_DATASETS = os.getenv("PREFETCH_DATASETS") == "TRUE"
+
+# Opt-in: filter the latest-measures and large-jumps pages in SQL, loading only
+# the selected rows instead of the whole table
+SERVER_SIDE_FILTERS = os.getenv("SERVER_SIDE_FILTERS") == "TRUE"
+
+# Number of query and span timings kept for the developer timing panel
+TIMINGS_MAX_ENTRIES = int(os.getenv("TIMINGS_MAX_ENTRIES", 2000))
+
+# Retries (with exponential backoff) for Databricks jobs API calls, and how
+# often (seconds) a triggered publishing job is polled until it finishes
+JOB_API_RETRIES = int(os.getenv("JOB_API_RETRIES", 3))
+JOB_STATUS_POLL_INTERVAL = int(os.getenv("JOB_STATUS_POLL_INTERVAL", 15))
+JOB_API_TIMEOUT = 30
+JOB_STATUS_POLL_TIMEOUT = 3 * 3600
+
+# Changes submitted for a page within this many seconds are published by one job run
+JOB_DEBOUNCE_SECONDS = int(os.getenv("JOB_DEBOUNCE_SECONDS", 60))
+
+# Edits are committed to a local SQLite queue and written to the warehouse by a
+# background flusher every WRITE_QUEUE_FLUSH_INTERVAL seconds. A submission that
+# keeps failing is retried with backoff up to WRITE_QUEUE_MAX_ATTEMPTS times.
+WRITE_QUEUE_PATH = os.getenv("WRITE_QUEUE_PATH", "write_queue.sqlite3")
+WRITE_QUEUE_FLUSH_INTERVAL = int(os.getenv("WRITE_QUEUE_FLUSH_INTERVAL", 5))
+WRITE_QUEUE_MAX_ATTEMPTS = int(os.getenv("WRITE_QUEUE_MAX_ATTEMPTS", 10))
+WRITE_QUEUE_MAX_BACKOFF = 300
+# A flusher's claim on the submissions it is applying; once it expires (e.g. the
+# app stopped mid-write) they are claimed again
+WRITE_QUEUE_LEASE = 600
+# Applied submissions are kept this long before being purged from the queue
+WRITE_QUEUE_RETENTION = 7 * 24 * 3600
+
+# Opt-in: directory where every page dataset is saved as an Arrow IPC snapshot.
+# Pages then start from the latest snapshot while the warehouse is queried.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+# Seconds between background incremental refreshes of the page datasets (0 = off)
+DATASET_REFRESH_INTERVAL = int(os.getenv("DATASET_REFRESH_INTERVAL", 0))
+
+# DataFrames held by sessions idle for SESSION_IDLE_TIMEOUT seconds are dropped,
+# least recently active first, while all sessions together use more than this
+SESSION_MEMORY_BUDGET_MB = int(os.getenv("SESSION_MEMORY_BUDGET_MB", 512))
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", 600))
+SESSION_MEMORY_CHECK_INTERVAL = 30
+
+# String columns are only made categorical when at most this share of their
+# values are distinct
+CATEGORY_MAX_RATIO = 0.5
+# float64 columns are stored as float32 when no value changes by more than this
+FLOAT32_RTOL = 1e-6
+
+WAREHOUSE_WARMING = "warming"
+WAREHOUSE_READY = "ready"
+WAREHOUSE_FAILED = "failed"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_SKIPPED = "skipped"
+
+WRITE_PENDING = "pending"
+WRITE_APPLYING = "applying"
+WRITE_APPLIED = "applied"
+WRITE_FAILED = "failed"
+
 FETCH_LARGE_JUMPS_QUERY = f"""
     SELECT
         siteID,
@@ -33,27 +157,38 @@ FETCH_LARGE_JUMPS_QUERY = f"""
         CAST(latestObsDT AS DATE) > DATE_SUB(CURRENT_DATE(), 30)
 """
 
+# The UPDATE_* and INSERT_NEW_LOGS queries are batch templates: {values} and
+# {columns} are filled in by execute_batch() with one parameterized VALUES row
+# per edited row or log entry
 UPDATE_LARGE_JUMPS_QUERY = f"""
-    UPDATE 
-        {LARGE_JUMPS_TABLE}
-    SET 
-        actionItem = %(action_item)s
-    WHERE 
-        siteID = %(site_id)s 
+    MERGE INTO 
+        {LARGE_JUMPS_TABLE} AS target
+    USING (
+        SELECT * FROM VALUES {{values}} AS source({{columns}})
+    ) AS source
+    ON 
+        target.siteID = source.site_id 
     AND 
-        datasetID = %(dataset_id)s 
+        target.datasetID = source.dataset_id 
     AND 
-        measure = %(measure)s
+        target.measure = source.measure
     AND 
-        previousObsDT = %(previous_obs_dt)s
+        target.previousObsDT = source.previous_obs_dt
     AND 
-        latestObsDT = %(latest_obs_dt)s
+        target.latestObsDT = source.latest_obs_dt
+    WHEN MATCHED THEN UPDATE SET 
+        target.actionItem = source.action_item
 """
 
+# Keyset-paginated log query, newest first. {filters} and {keyset} are filled
+# in by build_log_filters() and build_log_keyset(); RowKey breaks ties between
+# entries written with the same Time (e.g. by one batched submit). Entries
+# written before LogID existed fall back to a concatenation of their columns.
 FETCH_LOG_QUERY = f"""
     SELECT 
+        LogID,
         User,
-        CAST(Time AS STRING),
+        Time,
         Page,
         Location,
         SiteID,
@@ -62,44 +197,74 @@ FETCH_LOG_QUERY = f"""
         EpiYear,
         ChangedColumn,
         OldValue,
-        NewValue
+        NewValue,
+        RowKey
+    FROM (
+        SELECT 
+            LogID,
+            User,
+            CAST(Time AS STRING) AS Time,
+            Time AS SortTime,
+            Page,
+            Location,
+            SiteID,
+            Measure,
+            EpiWeek,
+            EpiYear,
+            ChangedColumn,
+            OldValue,
+            NewValue,
+            COALESCE(
+                LogID,
+                CONCAT_WS(
+                    '|', User, Page, Location, SiteID, Measure, EpiWeek, EpiYear,
+                    ChangedColumn, OldValue, NewValue
+                )
+            ) AS RowKey
+        FROM 
+            {LOGS_TABLE}
+        WHERE 
+            {{filters}}
+    )
+    WHERE 
+        {{keyset}}
+    ORDER BY SortTime DESC, RowKey DESC
+    LIMIT {{limit}}
+"""
+
+COUNT_LOG_QUERY = f"""
+    SELECT 
+        COUNT(*) AS total
     FROM 
         {LOGS_TABLE}
+    WHERE 
+        {{filters}}
 """
 
-INSERT_LOG_QUERY = f"""
-    INSERT INTO {LOGS_TABLE} (
-        User,
-        Time,
-        Page,
-        Location,
-        SiteID,
-        Measure,
-        EpiWeek,
-        EpiYear,
-        ChangedColumn,
-        OldValue,
-        NewValue
-    )
-    VALUES (
-        %(User)s,
-        %(Time)s,
-        %(Page)s,
-        %(Location)s,
-        %(SiteID)s,
-        %(Measure)s,
-        %(EpiWeek)s,
-        %(EpiYear)s,
-        %(ChangedColumn)s,
-        %(OldValue)s,
-        %(NewValue)s
-    )
+# Only inserts the entries whose LogID is not logged yet, so a submission
+# retried by the write queue flusher is never logged twice
+INSERT_NEW_LOGS_QUERY = f"""
+    MERGE INTO {LOGS_TABLE} AS target
+    USING (
+        SELECT * FROM VALUES {{values}} AS source({{columns}})
+    ) AS source
+    ON target.LogID = source.LogID
+    WHEN NOT MATCHED THEN INSERT *
 """
 
+# {ids} is filled in by build_in_clause() with one parameter per LogID
+DELETE_LOGS_BY_ID_QUERY = f"""
+    DELETE FROM 
+        {LOGS_TABLE}
+    WHERE LogID IN ({{ids}})
+"""
+
+# Only used for legacy entries that were written without a LogID
 DELETE_LOG_QUERY = f"""
     DELETE FROM 
         {LOGS_TABLE}
-    WHERE User = %(User)s
+    WHERE LogID IS NULL
+    AND User = %(User)s
     AND Time = %(Time)s
     AND Page = %(Page)s
     AND Location = %(Location)s
@@ -124,18 +289,21 @@ FETCH_MPOX_QUERY = f"""
 """
 
 UPDATE_MPOX_QUERY = f"""
-    UPDATE 
-        {MPOX_TABLE}
-    SET 
-        g2r_label = %(g2r_label)s
-    WHERE 
-        Location = %(location)s 
+    MERGE INTO 
+        {MPOX_TABLE} AS target
+    USING (
+        SELECT * FROM VALUES {{values}} AS source({{columns}})
+    ) AS source
+    ON 
+        target.Location = source.location 
     AND 
-        EpiYear = %(epi_year)s
+        target.EpiYear = source.epi_year
     AND 
-        EpiWeek = %(epi_week)s
+        target.EpiWeek = source.epi_week
     AND 
-        Week_start = %(week_start)s
+        target.Week_start = source.week_start
+    WHEN MATCHED THEN UPDATE SET 
+        target.g2r_label = source.g2r_label
 """
 
 FETCH_WW_TRENDS_QUERY = f"""
@@ -153,12 +321,16 @@ FETCH_WW_TRENDS_QUERY = f"""
 """
 
 UPDATE_WW_TRENDS_QUERY = f"""
-    UPDATE {WW_TRENDS_TABLE}
-    SET Viral_Activity_Level = %(viral_activity_level)s
-    WHERE Location = %(location)s 
-    AND measure = %(measure)s
-    AND City = %(city)s
-    AND Province = %(province)s
+    MERGE INTO {WW_TRENDS_TABLE} AS target
+    USING (
+        SELECT * FROM VALUES {{values}} AS source({{columns}})
+    ) AS source
+    ON target.Location = source.location 
+    AND target.measure = source.measure
+    AND target.City = source.city
+    AND target.Province = source.province
+    WHEN MATCHED THEN UPDATE SET 
+        target.Viral_Activity_Level = source.viral_activity_level
 """
 
 FETCH_LATEST_MEASURES_QUERY = f"""
@@ -180,78 +352,2353 @@ FETCH_LATEST_MEASURES_QUERY = f"""
         {LATEST_MEASURES_TABLE}
 """
 
-FETCH_BEFORE_LARGE_JUMP_QUERY = f"""
-    SELECT * FROM 
-        {ALLSITES_TABLE}
+# Batch template: {values} and {columns} hold one row per selected jump
+# (jump_idx, site_id, measure, previous_obs_dt, latest_obs_dt). Returns the
+# 4 observations before previousObsDT and the first one after latestObsDT
+# for every jump in a single scan of the ALLSITES table.
+FETCH_LARGE_JUMP_HISTORY_QUERY = f"""
+    WITH jumps AS (
+        SELECT * FROM VALUES {{values}} AS jumps({{columns}})
+    ),
+    history AS (
+        SELECT
+            jumps.jump_idx,
+            allsites.collDT,
+            allsites.valavg,
+            CASE 
+                WHEN allsites.collDT < CAST(jumps.previous_obs_dt AS DATE) THEN 'before' 
+                ELSE 'after' 
+            END AS position
+        FROM 
+            jumps
+        JOIN 
+            {ALLSITES_TABLE} AS allsites
+        ON 
+            allsites.siteID = jumps.site_id 
+        AND 
+            allsites.measure = jumps.measure
+        WHERE 
+            allsites.collDT < CAST(jumps.previous_obs_dt AS DATE)
+        OR 
+            allsites.collDT > CAST(jumps.latest_obs_dt AS DATE)
+    ),
+    ranked AS (
+        SELECT
+            *,
+            ROW_NUMBER() OVER (
+                PARTITION BY jump_idx, position
+                ORDER BY CASE WHEN position = 'before' THEN collDT END DESC, collDT ASC
+            ) AS position_rank
+        FROM 
+            history
+    )
+    SELECT 
+        jump_idx,
+        position,
+        collDT,
+        valavg
+    FROM 
+        ranked
     WHERE 
-        siteID = %(siteID)s 
-    AND 
-        measure = %(Measure)s 
-    AND 
-        collDT < CAST(%(previousObsDT)s AS DATE)
-    ORDER BY collDT DESC 
-    LIMIT 4
+        (position = 'before' AND position_rank <= 4)
+    OR 
+        (position = 'after' AND position_rank = 1)
+    ORDER BY jump_idx, collDT
 """
 
-FETCH_AFTER_LARGE_JUMP_QUERY = f"""
-    SELECT * FROM 
-        {ALLSITES_TABLE}
-    WHERE 
-        siteID = %(siteID)s 
-    AND 
-        measure = %(Measure)s 
-    AND 
-        collDT > CAST(%(latestObsDT)s AS DATE)
-    ORDER BY collDT ASC 
-    LIMIT 1
+
+# The datasets loaded by the pages, in navigation order. With server-side
+# filters, latest-measures and large-jumps only load the rows they show.
+PAGE_QUERIES = [FETCH_WW_TRENDS_QUERY, FETCH_MPOX_QUERY]
+if not SERVER_SIDE_FILTERS:
+    PAGE_QUERIES += [FETCH_LATEST_MEASURES_QUERY, FETCH_LARGE_JUMPS_QUERY]
+
+
+# The table behind each page dataset and the columns identifying one of its
+# rows, used to merge incremental changes into the cached dataset
+DATASET_TABLES = {
+    FETCH_WW_TRENDS_QUERY: WW_TRENDS_TABLE,
+    FETCH_MPOX_QUERY: MPOX_TABLE,
+    FETCH_LATEST_MEASURES_QUERY: LATEST_MEASURES_TABLE,
+    FETCH_LARGE_JUMPS_QUERY: LARGE_JUMPS_TABLE,
+}
+DATASET_KEYS = {
+    FETCH_WW_TRENDS_QUERY: ["Location", "measure", "City", "Province"],
+    FETCH_MPOX_QUERY: ["Location", "EpiYear", "EpiWeek"],
+    FETCH_LATEST_MEASURES_QUERY: ["siteID", "datasetID", "measure"],
+    FETCH_LARGE_JUMPS_QUERY: [
+        "siteID",
+        "datasetID",
+        "measure",
+        "previousObsDT",
+        "latestObsDT",
+    ],
+}
+# Page datasets whose query filters its table (large-jumps keeps a 30-day
+# window). The change feed has no way to tell which rows fell out of the
+# filter, so these are always reloaded in full.
+FILTERED_DATASETS = {FETCH_LARGE_JUMPS_QUERY}
+
+# Compact dtypes for the columns of each page dataset, see compact_dtypes().
+# Columns edited through the app (e.g. Viral_Activity_Level) stay plain strings
+# so any new value can be patched into the shared frame.
+DATASET_SCHEMAS = {
+    FETCH_WW_TRENDS_QUERY: {
+        "category": [
+            "Location",
+            "measure",
+            "latestTrends",
+            "LatestLevel",
+            "Grouping",
+            "City",
+            "Province",
+        ],
+    },
+    FETCH_MPOX_QUERY: {
+        "category": ["Location"],
+        "float32": ["EpiYear", "EpiWeek"],
+        "datetime": ["Week_start"],
+    },
+    FETCH_LATEST_MEASURES_QUERY: {
+        "category": ["name", "healthReg", "siteID", "datasetID", "measure"],
+        "float32": ["previousObs", "latestObs"],
+        "datetime": [
+            "previousObsDT",
+            "latestObsDT",
+            "previousReportDT",
+            "latestReportDT",
+        ],
+    },
+    FETCH_LARGE_JUMPS_QUERY: {
+        "category": ["siteID", "datasetID", "measure", "alertType"],
+        "float32": ["previousObs", "latestObs"],
+        "datetime": ["previousObsDT", "latestObsDT"],
+    },
+}
+
+# The MERGE template behind each editable page, the parameter holding the
+# edited value, the page dataset and whether edits are published by a job
+WRITE_TARGETS = {
+    "ww-trends": (
+        UPDATE_WW_TRENDS_QUERY,
+        "viral_activity_level",
+        FETCH_WW_TRENDS_QUERY,
+        True,
+    ),
+    "mpox": (UPDATE_MPOX_QUERY, "g2r_label", FETCH_MPOX_QUERY, True),
+    "large-jumps": (
+        UPDATE_LARGE_JUMPS_QUERY,
+        "action_item",
+        FETCH_LARGE_JUMPS_QUERY,
+        False,
+    ),
+}
+
+FETCH_TABLE_VERSION_QUERY = "DESCRIBE HISTORY {table} LIMIT 1"
+
+# A page dataset restricted by {where} (see build_filter_clause())
+FETCH_FILTERED_QUERY = """
+    SELECT * FROM ({query}) AS page_rows {where}
 """
 
+# The values offered by a page's filter multiselect, taken from the rows the
+# page query returns so options outside its WHERE clause are never offered
+FETCH_DISTINCT_VALUES_QUERY = """
+    SELECT DISTINCT {column}
+    FROM ({query}) AS page_rows
+    WHERE {column} IS NOT NULL
+    ORDER BY {column}
+"""
+
+# The latest change of every key between two versions of a Delta table, read
+# from its change data feed (delta.enableChangeDataFeed must be on). A delete
+# and re-insert within one commit resolves to the insert.
+FETCH_TABLE_CHANGES_QUERY = """
+    SELECT {columns}, _change_type
+    FROM (
+        SELECT 
+            *,
+            ROW_NUMBER() OVER (
+                PARTITION BY {keys}
+                ORDER BY 
+                    _commit_version DESC,
+                    CASE WHEN _change_type = 'delete' THEN 1 ELSE 0 END
+            ) AS change_rank
+        FROM table_changes('{table}', {start_version}, {end_version})
+        WHERE _change_type != 'update_preimage'
+    )
+    WHERE change_rank = 1
+"""
+
+# The local write queue (SQLite). Times are Unix timestamps; updates and
+# log_entries are JSON lists encoded by encode_queue_value().
+CREATE_WRITE_QUEUE_QUERY = """
+    CREATE TABLE IF NOT EXISTS submissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        page TEXT NOT NULL,
+        user TEXT NOT NULL,
+        updates TEXT NOT NULL,
+        log_entries TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        next_attempt_at REAL NOT NULL,
+        applied_at REAL,
+        claimed_by TEXT,
+        lease_expires_at REAL
+    )
+"""
+
+
+# Used to name a query after its statement type and first table, e.g.
+# "SELECT catalog.schema.ww_trends" or "MERGE catalog.schema.mpox"
+QUERY_TABLE_PATTERN = re.compile(
+    r"\b(?:FROM|INTO|UPDATE)\s+(?!VALUES\b)([\w.`]+)", re.IGNORECASE
+)
+
+# The page each script thread is currently running, see set_current_page()
+_timing_context = threading.local()
+
+
+def set_current_page(page: str):
+    # Attribute the queries and spans recorded on this thread to page
+    _timing_context.page = page
+
+
+def get_current_page() -> str:
+    # Background threads (warm-up, prefetch) never run a page
+    return getattr(_timing_context, "page", "background")
+
+
+def get_query_name(query: str) -> str:
+    verb = query.split(None, 1)[0].upper() if query.strip() else ""
+    match = QUERY_TABLE_PATTERN.search(query)
+    return f"{verb} {match.group(1).strip('`')}" if match else verb
+
+
+def hash_params(params) -> str:
+    # A short, stable fingerprint of the query parameters (not the values themselves)
+    if not params:
+        return ""
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:12]
+
+
+class TimingRecorder:
+    """Process-wide ring buffers of query and span timings.
+
+    Queries are recorded by TimedCursor and spans by timed_span(); only the
+    latest ``max_entries`` of each are kept. Rerun counts per page and scope
+    (the whole page or one fragment) are kept in full.
+    """
+
+    def __init__(self, max_entries: int):
+        self._lock = threading.Lock()
+        self._queries = deque(maxlen=max_entries)
+        self._spans = deque(maxlen=max_entries)
+        self._reruns = {}
+
+    def record_query(self, record: dict):
+        with self._lock:
+            self._queries.append(record)
+
+    def record_span(self, record: dict):
+        with self._lock:
+            self._spans.append(record)
+
+    def record_rerun(self, page: str, scope: str):
+        with self._lock:
+            self._reruns[(page, scope)] = self._reruns.get((page, scope), 0) + 1
+
+    def get_queries(self) -> pd.DataFrame:
+        with self._lock:
+            records = list(self._queries)
+        return pd.DataFrame(
+            records,
+            columns=[
+                "time",
+                "page",
+                "query",
+                "params_hash",
+                "rows",
+                "bytes",
+                "seconds",
+                "error",
+            ],
+        )
+
+    def get_spans(self) -> pd.DataFrame:
+        with self._lock:
+            records = list(self._spans)
+        return pd.DataFrame(records, columns=["time", "page", "span", "seconds"])
+
+    def get_reruns(self) -> pd.DataFrame:
+        with self._lock:
+            records = [(*key, count) for key, count in self._reruns.items()]
+        return pd.DataFrame(records, columns=["page", "scope", "reruns"])
+
+    def clear(self):
+        with self._lock:
+            self._queries.clear()
+            self._spans.clear()
+            self._reruns.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def get_timing_recorder() -> TimingRecorder:
+    return TimingRecorder(TIMINGS_MAX_ENTRIES)
+
+
+@contextmanager
+def timed_span(name: str):
+    # Record how long a block of the current rerun takes (e.g. fetch, filter, render)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_timing_recorder().record_span(
+            {
+                "time": datetime.now(),
+                "page": get_current_page(),
+                "span": name,
+                "seconds": time.perf_counter() - start,
+            }
+        )
+
+
+def count_rerun(scope: str):
+    # Count a rerun of the current page ("page") or of one of its fragments
+    get_timing_recorder().record_rerun(get_current_page(), scope)
+
+
+def timed_fragment(name: str, **fragment_kwargs):
+    """Run the decorated function as an ``st.fragment`` named ``name``.
+
+    Widgets inside a fragment only rerun the fragment, not the whole page.
+    Every run is counted and timed as the ``fragment <name>`` span.
+    """
+
+    def decorator(func):
+        # Fragment reruns skip app.py, so the page is captured here
+        page = get_current_page()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            set_current_page(page)
+            count_rerun(name)
+            with timed_span(f"fragment {name}"):
+                return func(*args, **kwargs)
+
+        return st.fragment(wrapper, **fragment_kwargs)
+
+    return decorator
+
+
+class QueryCancelled(Exception):
+    """A query cancelled because the session that ran it ended or reran."""
+
+
+def is_script_run_preempted(ctx) -> bool:
+    # True once the session has ended, or a rerun was requested that stops the
+    # current script run (mirrors ScriptRequests.on_scriptrunner_yield())
+    if runtime.exists() and not runtime.get_instance().is_active_session(
+        ctx.session_id
+    ):
+        return True
+    requests = ctx.script_requests
+    if requests is None:
+        return False
+    # ScriptRequests has no public accessor for a pending request, so its
+    # private fields are read (as of the streamlit version pinned in
+    # requirements.txt). If they change, queries are only cancelled on timeout.
+    try:
+        state = requests._state
+        rerun_data = requests._rerun_data
+        if state == ScriptRequestType.STOP:
+            return True
+        if state == ScriptRequestType.RERUN:
+            # Reruns of other fragments wait for the current run to finish
+            return not (
+                rerun_data.fragment_id_queue
+                and not rerun_data.is_fragment_scoped_rerun
+            )
+    except AttributeError as e:
+        report_preemption_unsupported(str(e))
+    return False
+
+
+@functools.cache
+def report_preemption_unsupported(error: str):
+    # Printed once rather than on every watchdog tick
+    print(f"Cannot tell whether the script run was preempted: {error}")
+
+
+class QueryWatchdog:
+    """Cancels warehouse calls through their cursor's cancel API.
+
+    A call is cancelled once it runs past its timeout, or, when it is bound to
+    a script run, once that session ends or moves on to a new rerun.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._calls = {}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def watch(self, cursor, timeout: int, ctx=None) -> dict:
+        call = {
+            "cursor": cursor,
+            "timeout": timeout,
+            "deadline": time.monotonic() + timeout if timeout else None,
+            "ctx": ctx,
+            "reason": None,
+            # Held while the call is cancelled, see unwatch()
+            "lock": threading.Lock(),
+            "finished": False,
+        }
+        with self._lock:
+            self._calls[id(call)] = call
+        return call
+
+    def unwatch(self, call: dict):
+        with self._lock:
+            self._calls.pop(id(call), None)
+        # Waits for a cancel in progress, so a finished call's cursor is never
+        # cancelled once it runs the next query
+        with call["lock"]:
+            call["finished"] = True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            # The calls to cancel are collected under the lock and cancelled
+            # after releasing it, so a slow cancel does not block other queries
+            expired = []
+            with self._lock:
+                for call in self._calls.values():
+                    if call["reason"] is not None:
+                        continue
+                    if call["deadline"] is not None and now > call["deadline"]:
+                        call["reason"] = "timeout"
+                    elif call["ctx"] is not None and is_script_run_preempted(
+                        call["ctx"]
+                    ):
+                        call["reason"] = "session"
+                    else:
+                        continue
+                    expired.append(call)
+            for call in expired:
+                with call["lock"]:
+                    if call["finished"]:
+                        continue
+                    try:
+                        call["cursor"].cancel()
+                    except Exception as e:
+                        print(f"Failed to cancel query: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_watchdog() -> QueryWatchdog:
+    return QueryWatchdog(QUERY_WATCHDOG_INTERVAL)
+
+
+class TimedCursor:
+    """Wraps a cursor to record the wall time, rows and bytes of every query.
+
+    The time of a query covers its execute call and every fetch until the next
+    execute (or flush). Bytes are only known for Arrow fetches. Every call is
+    watched by the QueryWatchdog, with the cursor's timeout and script run.
+    """
+
+    def __init__(self, cursor, recorder: TimingRecorder, timeout: int = None, ctx=None):
+        self._cursor = cursor
+        self._recorder = recorder
+        self._timeout = timeout
+        self._ctx = ctx
+        self._record = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query: str, parameters=None):
+        self.flush()
+        self._record = {
+            "time": datetime.now(),
+            "page": get_current_page(),
+            "query": get_query_name(query),
+            "params_hash": hash_params(parameters),
+            "rows": 0,
+            "bytes": 0,
+            "seconds": 0.0,
+            "error": None,
+        }
+        return self._timed(self._cursor.execute, query, parameters, count_rows=False)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, size: int):
+        return self._timed(self._cursor.fetchmany, size)
+
+    def fetchall_arrow(self):
+        return self._timed(self._cursor.fetchall_arrow)
+
+    def fetchmany_arrow(self, size: int):
+        return self._timed(self._cursor.fetchmany_arrow, size)
+
+    def _timed(self, method, *args, count_rows: bool = True):
+        watchdog = get_query_watchdog()
+        call = watchdog.watch(self._cursor, self._timeout, self._ctx)
+        start = time.perf_counter()
+        try:
+            result = method(*args)
+        except Exception as e:
+            error = e
+            if call["reason"] == "timeout":
+                error = TimeoutError(f"Query cancelled after {self._timeout} seconds")
+            elif call["reason"] == "session":
+                error = QueryCancelled("Query cancelled, the session ended or reran")
+            if self._record is not None:
+                self._record["error"] = type(error).__name__
+            if error is e:
+                raise
+            print(error)
+            raise error from e
+        finally:
+            watchdog.unwatch(call)
+            if self._record is not None:
+                self._record["seconds"] += time.perf_counter() - start
+        if self._record is not None and count_rows:
+            # Read the Arrow size now, before arrow_to_pandas frees the buffers
+            if isinstance(result, pa.Table):
+                self._record["rows"] += result.num_rows
+                self._record["bytes"] += result.nbytes
+            elif isinstance(result, list):
+                self._record["rows"] += len(result)
+            elif result is not None:
+                self._record["rows"] += 1
+        return result
+
+    def flush(self):
+        # Record the current query, if any
+        if self._record is not None:
+            self._recorder.record_query(self._record)
+            self._record = None
+
 
 def get_db_connection():
-    if "db_connection" not in st.session_state:
-        st.session_state.db_connection = sql.connect(
-            server_hostname=os.getenv("ADB_INSTANCE_NAME"),
-            http_path=os.getenv("ADB_HTTP_PATH"),
-            access_token=os.getenv("ADB_API_KEY"),
+    if DB_BACKEND == "local":
+        import local_db
+
+        conn = local_db.connect()
+        print("Created new local database connection")
+        return conn
+
+    conn = sql.connect(
+        server_hostname=os.getenv("ADB_INSTANCE_NAME"),
+        http_path=os.getenv("ADB_HTTP_PATH"),
+        access_token=os.getenv("ADB_API_KEY"),
+    )
+    print("Created new database connection")
+    return conn
+
+
+def close_db_connection(conn):
+    try:
+        conn.close()
+    except Exception as e:
+        print(f"Failed to close database connection: {e}")
+
+
+def is_connection_alive(conn) -> bool:
+    if not conn.open:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        return True
+    except sql.exc.Error:
+        return False
+
+
+class ConnectionPool:
+    """A bounded pool of Databricks connections shared by every session.
+
+    Idle connections are closed once they exceed ``idle_timeout`` and are
+    pinged before reuse, so a warehouse restart only costs a reconnect.
+    """
+
+    def __init__(self, max_size: int, idle_timeout: int, acquire_timeout: int):
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # (connection, time it was released) pairs, most recently used last
+        self._idle = []
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError("Timed out waiting for a free database connection")
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, released_at = self._idle.pop()
+                idle_for = time.monotonic() - released_at
+                if idle_for > self.idle_timeout:
+                    close_db_connection(conn)
+                    continue
+                if idle_for > DB_POOL_LIVENESS_INTERVAL and not is_connection_alive(
+                    conn
+                ):
+                    print("Discarding dead database connection")
+                    close_db_connection(conn)
+                    continue
+                return conn
+            return get_db_connection()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard: bool = False):
+        try:
+            if discard or not conn.open:
+                close_db_connection(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            close_db_connection(conn)
+
+
+@st.cache_resource(show_spinner=False)
+def get_connection_pool() -> ConnectionPool:
+    pool = ConnectionPool(
+        DB_POOL_MAX_SIZE, DB_POOL_IDLE_TIMEOUT, DB_POOL_ACQUIRE_TIMEOUT
+    )
+    # Close the idle connections when the app process exits
+    atexit.register(pool.close_all)
+    return pool
+
+
+@contextmanager
+def get_cursor(timeout: int = QUERY_TIMEOUT, bind_session: bool = False):
+    # Every call on the cursor is cancelled after timeout seconds. With
+    # bind_session, it is also cancelled once the calling session ends or
+    # reruns; only use it for queries whose result only that session needs.
+    pool = get_connection_pool()
+    for attempt in range(2):
+        conn = pool.acquire()
+        try:
+            cursor = conn.cursor()
+            break
+        except (sql.exc.OperationalError, sql.exc.InterfaceError) as e:
+            # The connection broke while idle (e.g. the warehouse restarted),
+            # so it is dropped and a new connection is tried once
+            pool.release(conn, discard=True)
+            if attempt:
+                raise
+            print(f"Reconnecting after a database connection error: {e}")
+        except BaseException:
+            pool.release(conn)
+            raise
+    discard = False
+    try:
+        print("Created new cursor")
+        with cursor:
+            timed_cursor = TimedCursor(
+                cursor,
+                get_timing_recorder(),
+                timeout,
+                get_script_run_ctx() if bind_session else None,
+            )
+            try:
+                yield timed_cursor
+            finally:
+                timed_cursor.flush()
+    except (sql.exc.OperationalError, sql.exc.InterfaceError):
+        # The connection is likely broken (e.g. the warehouse restarted),
+        # so drop it and let the next caller reconnect
+        discard = True
+        raise
+    finally:
+        pool.release(conn, discard=discard)
+
+
+def iter_arrow_chunks(cursor, chunk_size: int = FETCH_CHUNK_SIZE):
+    # Stream the cursor's result as Arrow tables of at most chunk_size rows
+    while True:
+        table = cursor.fetchmany_arrow(chunk_size)
+        if table.num_rows == 0:
+            return
+        yield table
+
+
+def arrow_to_pandas(table) -> pd.DataFrame:
+    # split_blocks avoids consolidating columns into one block (so most columns
+    # convert without a copy) and self_destruct frees the Arrow buffers as we go
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def fetch_dataframe(cursor, chunk_size: int = None) -> pd.DataFrame:
+    # Materialize the cursor's result via the connector's Arrow path. With a
+    # chunk_size the result is pulled in batches instead of in one fetch.
+    if chunk_size is None:
+        return arrow_to_pandas(cursor.fetchall_arrow())
+    tables = list(iter_arrow_chunks(cursor, chunk_size))
+    if not tables:
+        return arrow_to_pandas(cursor.fetchall_arrow())
+    return arrow_to_pandas(pa.concat_tables(tables))
+
+
+class CountingLRUCache:
+    """A thread-safe LRU cache that counts hits and misses.
+
+    Meant to be created once per process (e.g. via st.cache_resource) for
+    values that never change once fetched.
+    """
+
+    def __init__(self, max_entries: int):
+        self._lock = threading.Lock()
+        self._cache = LRUCache(maxsize=max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+                "max_entries": self._cache.maxsize,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def get_counting_caches() -> dict[str, CountingLRUCache]:
+    # name -> CountingLRUCache, whose stats are shown in the timing panel
+    return {}
+
+
+class DatasetVersions:
+    """Process-wide version counters for cached datasets.
+
+    A dataset's version is bumped whenever it is (re)loaded or edited, so
+    anything derived from it can be cached under (query, version). The
+    counter outlives the cached datasets, so a reloaded dataset never reuses
+    the version of the one it replaced.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def bump(self, query: str) -> int:
+        with self._lock:
+            self._versions[query] = self._versions.get(query, 0) + 1
+            return self._versions[query]
+
+
+@st.cache_resource(show_spinner=False)
+def get_dataset_versions() -> DatasetVersions:
+    return DatasetVersions()
+
+
+def bump_dataset_version(query: str, dataset: "CachedDataset" = None) -> int:
+    # Give the dataset a new version. Taken under the dataset's lock, as in
+    # CachedDataset.swap(), so a frame is never seen with another's version.
+    dataset = dataset or load_dataset(query)
+    with dataset.lock:
+        dataset.version = get_dataset_versions().bump(query)
+        return dataset.version
+
+
+def compact_dtypes(df: pd.DataFrame, schema: dict[str, list[str]]) -> pd.DataFrame:
+    # Cast the schema's columns to smaller dtypes; columns missing from df and
+    # conversions that would lose information are skipped
+    df = df.copy(deep=False)
+    for column in schema.get("category", []):
+        if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            if df[column].nunique() <= CATEGORY_MAX_RATIO * len(df):
+                df[column] = df[column].astype("category")
+    for column in schema.get("float32", []):
+        if column in df and df[column].dtype == "float64":
+            values = df[column].to_numpy()
+            compact = values.astype("float32")
+            if np.allclose(compact, values, rtol=FLOAT32_RTOL, atol=0, equal_nan=True):
+                df[column] = compact
+    for column in schema.get("datetime", []):
+        if column in df and df[column].dtype == "object":
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def get_memory_usage(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+class CachedDataset:
+    """A page dataset in the shared cache and the table version it reflects.
+
+    ``df`` is replaced (not mutated) by refresh_dataset(), so sessions pick up
+    the refreshed frame the next time they call fetch_dataset(). A dataset
+    loaded from a snapshot is not ``live`` until the warehouse has answered.
+
+    ``refresh_lock`` is held while the warehouse is read for a refresh, so one
+    refresh runs at a time. ``lock`` is only held to swap in its result, so
+    readers never wait on the warehouse.
+    """
+
+    def __init__(
+        self,
+        df: pd.DataFrame,
+        table_version: int = None,
+        live: bool = True,
+        loaded_at: datetime = None,
+    ):
+        self.lock = threading.Lock()
+        # Reentrant so refresh_dataset() can reload the frame while holding it
+        self.refresh_lock = threading.RLock()
+        self.df = df
+        # Delta table version the frame reflects, None if it can't be tracked
+        self.table_version = table_version
+        self.live = live
+        self.loaded_at = loaded_at or datetime.now()
+        self.refreshed_at = self.loaded_at
+        # See bump_dataset_version()
+        self.version = 0
+
+    def swap(self, query: str, df: pd.DataFrame, table_version: int, reloaded: bool):
+        # Swap in a frame read from the warehouse, together with its new version
+        with self.lock:
+            self.df = df
+            self.table_version = table_version
+            self.live = True
+            self.refreshed_at = datetime.now()
+            if reloaded:
+                self.loaded_at = self.refreshed_at
+            self.version = get_dataset_versions().bump(query)
+
+
+@st.cache_resource(show_spinner=False)
+def get_loaded_datasets() -> dict[str, CachedDataset]:
+    # query -> the latest CachedDataset. It outlives its dataset cache entry, so
+    # it can be served while load_dataset() revalidates it.
+    return {}
+
+
+def get_table_version(table: str) -> int:
+    # The latest Delta version of table, or None if it has no history to read
+    if DB_BACKEND == "local" or table is None:
+        return None
+    try:
+        with get_cursor() as cursor:
+            cursor.execute(FETCH_TABLE_VERSION_QUERY.format(table=table))
+            return int(cursor.fetchone()[0])
+    except sql.exc.Error as e:
+        print(f"Could not read the history of {table}: {e}")
+        return None
+
+
+def read_dataset(query: str) -> tuple[pd.DataFrame, int]:
+    # Read the version first: changes committed during the fetch are then
+    # applied again by the next refresh, which is harmless
+    table_version = get_table_version(DATASET_TABLES.get(query))
+    with get_cursor() as cursor:
+        cursor.execute(query)
+        df = fetch_dataframe(cursor, chunk_size=FETCH_CHUNK_SIZE)
+    df = compact_dtypes(df, DATASET_SCHEMAS.get(query, {}))
+    print(
+        f"Fetched {len(df)} rows into the dataset cache "
+        f"({get_memory_usage(df) / 2**20:.1f} MB)"
+    )
+    get_warehouse_status().set(WAREHOUSE_READY)
+    return df, table_version
+
+
+def get_snapshot_path(query: str) -> str:
+    name = hashlib.sha256(query.encode()).hexdigest()[:16]
+    return os.path.join(SNAPSHOT_DIR, f"{name}.arrow")
+
+
+def save_snapshot(query: str, dataset: CachedDataset):
+    # Written to a temporary file and renamed over the previous snapshot, so a
+    # reader never sees a partial file
+    if not SNAPSHOT_DIR:
+        return
+    with dataset.lock:
+        df, table_version = dataset.df, dataset.table_version
+        refreshed_at = dataset.refreshed_at
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"refreshed_at"] = refreshed_at.isoformat().encode()
+    if table_version is not None:
+        metadata[b"table_version"] = str(table_version).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = get_snapshot_path(query)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save the dataset snapshot {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_snapshot(query: str) -> CachedDataset:
+    # The latest snapshot of the dataset (memory-mapped), or None if there is none
+    path = get_snapshot_path(query)
+    if not os.path.exists(path):
+        return None
+    try:
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            df = table.to_pandas()
+    except (OSError, pa.ArrowInvalid) as e:
+        print(f"Could not read the dataset snapshot {path}: {e}")
+        return None
+    metadata = table.schema.metadata or {}
+    table_version = metadata.get(b"table_version")
+    print(f"Loaded {len(df)} rows from the dataset snapshot {path}")
+    return CachedDataset(
+        compact_dtypes(df, DATASET_SCHEMAS.get(query, {})),
+        int(table_version) if table_version is not None else None,
+        live=False,
+        loaded_at=datetime.fromisoformat(metadata[b"refreshed_at"].decode()),
+    )
+
+
+def reload_dataset(query: str, dataset: CachedDataset):
+    # Replace the dataset's frame with a full read from the warehouse
+    with dataset.refresh_lock:
+        df, table_version = read_dataset(query)
+        dataset.swap(query, df, table_version, reloaded=True)
+    save_snapshot(query, dataset)
+
+
+def revalidate_dataset(query: str, dataset: CachedDataset):
+    # Bring a served dataset up to date (filtered datasets are reloaded in
+    # full, see refresh_dataset()); a snapshot stays read-only if the
+    # warehouse can't be reached
+    try:
+        refresh_dataset(query, dataset)
+    except Exception as e:
+        print(f"Could not revalidate the dataset: {e}")
+
+
+@st.cache_resource(
+    ttl=DATASET_CACHE_TTL, max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner=False
+)
+def load_dataset(query: str) -> CachedDataset:
+    # An expired dataset is served again (still editable), or else the latest
+    # snapshot (read-only until live) when SNAPSHOT_DIR is set, while the live
+    # data is read in the background. That way a suspended warehouse never
+    # blocks the page. Only a dataset with neither is read right away.
+    dataset = get_loaded_datasets().get(query)
+    if dataset is None and SNAPSHOT_DIR:
+        dataset = load_snapshot(query)
+        if dataset is not None:
+            bump_dataset_version(query, dataset)
+    if dataset is not None:
+        thread = threading.Thread(
+            target=revalidate_dataset, args=(query, dataset), daemon=True
         )
-        print("Created new database connection")
-    return st.session_state.db_connection
+        add_script_run_ctx(thread, get_script_run_ctx())
+        thread.start()
+    else:
+        dataset = CachedDataset(*read_dataset(query))
+        bump_dataset_version(query, dataset)
+        save_snapshot(query, dataset)
+    get_loaded_datasets()[query] = dataset
+    return dataset
 
 
-def get_cursor():
-    conn = get_db_connection()
-    print("Created new cursor")
-    return conn.cursor()
+def is_dataset_live(query: str) -> bool:
+    # False while the page is showing a snapshot, edits are disabled until then
+    return load_dataset(query).live
 
 
-def trigger_job_run(page: str, log_entries: list[dict] = None) -> int:
-    # do not run job if in development mode
-    if os.getenv("DEVELOPMENT") == "TRUE":
-        return 200
+def fetch_dataset(query: str) -> pd.DataFrame:
+    # The returned DataFrame is shared by every session in this process, so
+    # edits should patch it in place (or call invalidate_dataset) rather than copy it
+    return load_dataset(query).df
+
+
+def fetch_versioned_dataset(query: str) -> tuple[pd.DataFrame, int]:
+    # The shared DataFrame and its version, read together so anything cached
+    # under the version is derived from that exact frame
+    dataset = load_dataset(query)
+    with dataset.lock:
+        return dataset.df, dataset.version
+
+
+def invalidate_dataset(query: str = None):
+    # Drop a single cached dataset, or every cached dataset if no query is
+    # given, so the next load reads it again. Their latest frames and snapshots
+    # may hold edits that were never saved, so they are not served again.
+    queries = list(DATASET_TABLES) if query is None else [query]
+    for query in queries:
+        get_loaded_datasets().pop(query, None)
+        if SNAPSHOT_DIR and os.path.exists(get_snapshot_path(query)):
+            os.remove(get_snapshot_path(query))
+        load_dataset.clear(query)
+
+
+@st.cache_resource(
+    ttl=DATASET_CACHE_TTL, max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner=False
+)
+def fetch_distinct_values(query: str, column: str) -> list:
+    # Distinct values of one column of a page dataset
+    with get_cursor() as cursor:
+        cursor.execute(FETCH_DISTINCT_VALUES_QUERY.format(column=column, query=query))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def build_filter_clause(filters: tuple[tuple[str, tuple], ...]) -> tuple[str, dict]:
+    # Render ((column, values), ...) as "WHERE column IN (...) AND ..." with the
+    # values sent as query parameters. A column with no values matches nothing.
+    predicates = []
+    params = {}
+    for column, values in filters:
+        if not values:
+            predicates.append("FALSE")
+            continue
+        placeholders, column_params = build_in_clause(list(values), column)
+        predicates.append(f"{column} IN ({placeholders})")
+        params.update(column_params)
+    if not predicates:
+        return "", params
+    return "WHERE " + " AND ".join(predicates), params
+
+
+@st.cache_resource(
+    ttl=DATASET_CACHE_TTL, max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner=False
+)
+def load_filtered_dataset(
+    query: str, filters: tuple[tuple[str, tuple], ...]
+) -> pd.DataFrame:
+    where, params = build_filter_clause(filters)
+    with get_cursor() as cursor:
+        cursor.execute(FETCH_FILTERED_QUERY.format(query=query, where=where), params)
+        df = fetch_dataframe(cursor, chunk_size=FETCH_CHUNK_SIZE)
+    print(f"Fetched {len(df)} filtered rows into the dataset cache")
+    get_warehouse_status().set(WAREHOUSE_READY)
+    df = compact_dtypes(df, DATASET_SCHEMAS.get(query, {}))
+    get_filtered_frames()[id(df)] = df
+    return df
+
+
+@st.cache_resource(show_spinner=False)
+def get_filtered_frames() -> weakref.WeakValueDictionary:
+    # id -> cached filtered DataFrame, see get_shared_frame_ids(); entries
+    # disappear once the filtered dataset cache drops them
+    return weakref.WeakValueDictionary()
+
+
+def fetch_filtered_dataset(query: str, filters: dict[str, list]) -> pd.DataFrame:
+    # The rows of a page dataset matching every {column: selected values}
+    # filter; columns mapped to None (e.g. everything selected) are not filtered.
+    # Like fetch_dataset(), the result is cached and shared by every session.
+    return load_filtered_dataset(
+        query,
+        tuple(
+            (column, tuple(values))
+            for column, values in filters.items()
+            if values is not None
+        ),
+    )
+
+
+def invalidate_filtered_datasets():
+    load_filtered_dataset.clear()
+
+
+def merge_changes(
+    df: pd.DataFrame, changes: pd.DataFrame, keys: list[str]
+) -> pd.DataFrame:
+    # Apply the latest change per key to a copy of df. Updated rows keep their
+    # index label, inserted rows are appended and deleted rows are dropped.
+    key_index = pd.MultiIndex.from_frame(df[keys])
+    labels = pd.Series(df.index, index=key_index)
+    labels = labels[~labels.index.duplicated(keep="last")]
+
+    upserts = changes[changes["_change_type"] != "delete"]
+    upsert_labels = labels.reindex(pd.MultiIndex.from_frame(upserts[keys])).to_numpy()
+    is_new = pd.isna(upsert_labels)
+    start = df.index.max() + 1 if len(df) else 0
+    upsert_labels[is_new] = np.arange(start, start + is_new.sum())
+    upserts = upserts[df.columns].set_index(pd.Index(upsert_labels.astype("int64")))
+
+    unchanged = df[~key_index.isin(pd.MultiIndex.from_frame(changes[keys]))]
+    return pd.concat([unchanged, upserts]).sort_index()
+
+
+def refresh_dataset(query: str, dataset: CachedDataset = None) -> int:
+    # Merge the rows changed since the dataset was loaded into the shared cache
+    # and return how many keys changed. Tables whose change feed can't be read
+    # and filtered datasets are reloaded in full instead, and None is returned.
+    # Either way a dataset loaded from a snapshot is live afterwards.
+    dataset = dataset or load_dataset(query)
+    table = DATASET_TABLES[query]
+    # The warehouse is read holding only refresh_lock; dataset.lock is taken
+    # by swap() alone, so readers of the dataset never wait on the warehouse
+    with dataset.refresh_lock:
+        df, table_version = dataset.df, dataset.table_version
+        latest_version = None
+        if table_version is not None and query not in FILTERED_DATASETS:
+            latest_version = get_table_version(table)
+        if latest_version is None:
+            reload_dataset(query, dataset)
+            return None
+        if latest_version == table_version:
+            with dataset.lock:
+                dataset.live = True
+                dataset.refreshed_at = datetime.now()
+            return 0
+
+        try:
+            with get_cursor() as cursor:
+                cursor.execute(
+                    FETCH_TABLE_CHANGES_QUERY.format(
+                        columns=", ".join(df.columns),
+                        keys=", ".join(DATASET_KEYS[query]),
+                        table=table,
+                        start_version=table_version + 1,
+                        end_version=latest_version,
+                    )
+                )
+                changes = fetch_dataframe(cursor)
+        except sql.exc.Error as e:
+            print(f"Could not read the change feed of {table}, reloading it: {e}")
+            reload_dataset(query, dataset)
+            return None
+
+        merged = compact_dtypes(
+            merge_changes(df, changes, DATASET_KEYS[query]),
+            DATASET_SCHEMAS.get(query, {}),
+        )
+        dataset.swap(query, merged, latest_version, reloaded=False)
+    save_snapshot(query, dataset)
+    print(f"Merged {len(changes)} changed rows into the dataset cache")
+    return len(changes)
+
+
+def refresh_datasets_periodically():
+    while True:
+        time.sleep(DATASET_REFRESH_INTERVAL)
+        for query in PAGE_QUERIES:
+            try:
+                refresh_dataset(query)
+            except Exception as e:
+                print(f"Background dataset refresh failed: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def start_dataset_refresher() -> bool:
+    # Runs once per process when DATASET_REFRESH_INTERVAL is set
+    if DATASET_REFRESH_INTERVAL <= 0:
+        return False
+    thread = threading.Thread(target=refresh_datasets_periodically, daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+    return True
+
+
+@st.fragment(run_every=5)
+def render_snapshot_badge(query: str):
+    # Shown while the page serves a snapshot; reruns the page once the live
+    # data has been swapped in
+    dataset = load_dataset(query)
+    if dataset.live:
+        st.rerun()
+    st.warning(
+        f"📦 Showing saved data as of {dataset.loaded_at:%Y-%m-%d %H:%M:%S} "
+        "while the latest data loads. Editing is disabled until then."
+    )
+
+
+def show_refresh_button(query: str):
+    # "Data as of" caption and an on-demand incremental refresh of the dataset
+    if "refreshed_rows" in st.session_state:
+        changed = st.session_state.pop("refreshed_rows")
+        if changed is None:
+            st.toast("Data reloaded.", icon="🔄")
+        else:
+            st.toast(f"Data refreshed: {changed} row(s) changed.", icon="🔄")
+
+    dataset = load_dataset(query)
+    if not dataset.live:
+        render_snapshot_badge(query)
+        return
+    left, right = st.columns([5, 1], vertical_alignment="center")
+    left.caption(f"Data as of {dataset.refreshed_at:%Y-%m-%d %H:%M:%S}")
+    if right.button("🔄 Refresh", use_container_width=True):
+        with st.spinner("Refreshing data..."):
+            st.session_state.refreshed_rows = refresh_dataset(query)
+        st.rerun()
+
+
+class WarehouseStatus:
+    """The state of the SQL warehouse as seen by the background warm-up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = WAREHOUSE_WARMING
+        self.error = None
+        self.updated_at = datetime.now()
+
+    def set(self, state: str, error: str = None):
+        with self._lock:
+            self.state = state
+            self.error = error
+            self.updated_at = datetime.now()
+
+
+@st.cache_resource(show_spinner=False)
+def get_prefetch_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(
+        max_workers=len(PAGE_QUERIES), thread_name_prefix="prefetch"
+    )
+
+
+def prefetch_datasets() -> list[Future]:
+    # Load every page's dataset into the shared cache concurrently. A page that
+    # asks for a dataset still being prefetched only waits for that query.
+    ctx = get_script_run_ctx()
+
+    def prefetch(query: str):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fetch_dataset(query)
+
+    executor = get_prefetch_executor()
+    return [executor.submit(prefetch, query) for query in PAGE_QUERIES]
+
+
+def start_session_prefetch():
+    # Kick off the prefetch once per session when PREFETCH_DATASETS is enabled
+    if PREFETCH_DATASETS and "prefetch_started" not in st.session_state:
+        st.session_state.prefetch_started = True
+        prefetch_datasets()
+
+
+def ping_warehouse():
+    with get_cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+
+
+def warm_up_warehouse(status: WarehouseStatus):
+    # Wake the warehouse with a trivial query, then load every page's dataset
+    # into the shared cache so the first visitor does not wait on a cold start
+    status.set(WAREHOUSE_WARMING)
+    try:
+        ping_warehouse()
+        for future in wait(prefetch_datasets()).done:
+            future.result()
+        status.set(WAREHOUSE_READY)
+        print("Warehouse warm-up finished")
+    except Exception as e:
+        status.set(WAREHOUSE_FAILED, str(e))
+        print(f"Warehouse warm-up failed: {e}")
+
+
+def in_keep_warm_hours(now: datetime) -> bool:
+    if not WAREHOUSE_KEEP_WARM_HOURS or now.weekday() >= 5:
+        return False
+    start, end = (int(hour) for hour in WAREHOUSE_KEEP_WARM_HOURS.split("-"))
+    return start <= now.hour < end
+
+
+def keep_warehouse_warm(status: WarehouseStatus):
+    while True:
+        time.sleep(WAREHOUSE_KEEP_WARM_INTERVAL)
+        if not in_keep_warm_hours(datetime.now()):
+            continue
+        try:
+            ping_warehouse()
+            status.set(WAREHOUSE_READY)
+        except Exception as e:
+            status.set(WAREHOUSE_FAILED, str(e))
+            print(f"Warehouse keep-warm ping failed: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def get_warehouse_status() -> WarehouseStatus:
+    return WarehouseStatus()
+
+
+@st.cache_resource(show_spinner=False)
+def start_warehouse_warmup() -> WarehouseStatus:
+    # Runs once per process: warm up the warehouse on a background thread and
+    # optionally keep it warm during business hours
+    status = get_warehouse_status()
+    targets = [warm_up_warehouse]
+    if WAREHOUSE_KEEP_WARM_HOURS:
+        targets.append(keep_warehouse_warm)
+    for target in targets:
+        thread = threading.Thread(target=target, args=(status,), daemon=True)
+        add_script_run_ctx(thread, get_script_run_ctx())
+        thread.start()
+    return status
+
+
+def show_warehouse_status():
+    status = get_warehouse_status()
+    if status.state == WAREHOUSE_WARMING:
+        st.info(
+            "⏳ The data warehouse is warming up. Data will show up as soon as it is ready."
+        )
+    elif status.state == WAREHOUSE_FAILED:
+        st.warning(f"⚠️ The data warehouse could not be reached: {status.error}")
+
+
+def summarize_timings(df: pd.DataFrame, by: list[str]) -> pd.DataFrame:
+    # Count and latency percentiles (seconds) per group, slowest p95 first
+    summary = df.groupby(by)["seconds"].agg(
+        count="count",
+        mean="mean",
+        p50="median",
+        p95=lambda seconds: seconds.quantile(0.95),
+        max="max",
+    )
+    if "rows" in df:
+        summary["rows"] = df.groupby(by)["rows"].sum()
+        summary["bytes"] = df.groupby(by)["bytes"].sum()
+    return summary.sort_values("p95", ascending=False).reset_index()
+
+
+def format_metric_labels(row: pd.Series, labels: list[str]) -> str:
+    # e.g. page="Mpox Trends",query="SELECT catalog.schema.mpox"
+    values = (
+        str(row[label]).replace("\\", "\\\\").replace('"', '\\"') for label in labels
+    )
+    return ",".join(f'{label}="{value}"' for label, value in zip(labels, values))
+
+
+def export_metrics() -> str:
+    # The recorded timings as Prometheus text-format summaries
+    recorder = get_timing_recorder()
+    lines = []
+    for name, df, labels in [
+        ("streamlit_query_seconds", recorder.get_queries(), ["page", "query"]),
+        ("streamlit_span_seconds", recorder.get_spans(), ["page", "span"]),
+    ]:
+        lines.append(f"# TYPE {name} summary")
+        if df.empty:
+            continue
+        for _, row in summarize_timings(df, labels).iterrows():
+            label_str = format_metric_labels(row, labels)
+            lines.append(f'{name}{{{label_str},quantile="0.5"}} {row["p50"]:.6f}')
+            lines.append(f'{name}{{{label_str},quantile="0.95"}} {row["p95"]:.6f}')
+            lines.append(f"{name}_sum{{{label_str}}} {row['mean'] * row['count']:.6f}")
+            lines.append(f"{name}_count{{{label_str}}} {row['count']}")
+    lines.append("# TYPE streamlit_reruns_total counter")
+    for _, row in recorder.get_reruns().iterrows():
+        label_str = format_metric_labels(row, ["page", "scope"])
+        lines.append(f"streamlit_reruns_total{{{label_str}}} {row['reruns']}")
+    queries = recorder.get_queries()
+    for name, column in [
+        ("streamlit_query_rows_total", "rows"),
+        ("streamlit_query_bytes_total", "bytes"),
+    ]:
+        lines.append(f"# TYPE {name} counter")
+        if queries.empty:
+            continue
+        for _, row in summarize_timings(queries, ["page", "query"]).iterrows():
+            label_str = format_metric_labels(row, ["page", "query"])
+            lines.append(f"{name}{{{label_str}}} {row[column]}")
+    return "\n".join(lines) + "\n"
+
+
+def show_timing_panel():
+    # Developer-only sidebar panel with the slowest pages, spans and queries
+    if os.getenv("DEVELOPMENT") != "TRUE":
+        return
+    recorder = get_timing_recorder()
+    spans = recorder.get_spans()
+    queries = recorder.get_queries()
+    with st.sidebar.expander("⏱️ Timings"):
+        if spans.empty and queries.empty:
+            st.caption("Nothing recorded yet.")
+            return
+        st.caption(f"Spans (seconds, last {TIMINGS_MAX_ENTRIES} per kind)")
+        st.dataframe(summarize_timings(spans, ["page", "span"]), hide_index=True)
+        st.caption("Reruns (whole page or a single fragment)")
+        st.dataframe(recorder.get_reruns(), hide_index=True)
+        if not queries.empty:
+            st.caption("Queries (seconds)")
+            st.dataframe(summarize_timings(queries, ["page", "query"]), hide_index=True)
+            st.caption("Latest queries")
+            st.dataframe(queries.tail(20).iloc[::-1], hide_index=True)
+        caches = list(get_counting_caches().items())
+        if caches:
+            st.caption("Caches")
+            st.dataframe(
+                pd.DataFrame([{"cache": name, **cache.stats()} for name, cache in caches]),
+                hide_index=True,
+            )
+        st.download_button(
+            "Export metrics",
+            export_metrics(),
+            file_name="metrics.prom",
+            mime="text/plain",
+        )
+        st.download_button(
+            "Export query log (CSV)",
+            queries.to_csv(index=False),
+            file_name="queries.csv",
+            mime="text/csv",
+        )
+
+
+def get_shared_frame_ids() -> set[int]:
+    # The DataFrames held by the shared dataset caches. A session referencing
+    # one owns none of its memory, and dropping the reference frees nothing.
+    frame_ids = {id(dataset.df) for dataset in list(get_loaded_datasets().values())}
+    frame_ids.update(get_filtered_frames().keys())
+    return frame_ids
+
+
+class SessionRegistry:
+    """The state of every connected session and when it last ran.
+
+    Used to report per-session memory and to drop the DataFrames of idle
+    sessions once all sessions together go over the memory budget. Sessions
+    the runtime no longer has an active connection for are forgotten, so
+    their state is not kept alive by the registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # session_id -> (SafeSessionState, time of its last rerun)
+        self._sessions = {}
+        self._last_check = 0.0
+
+    def touch(self, session_id: str, state):
+        with self._lock:
+            self._sessions[session_id] = (state, time.monotonic())
+
+    def drop_inactive(self):
+        # Forget the sessions whose browser tab was closed or disconnected;
+        # a reconnecting session registers again on its next rerun
+        if not runtime.exists():
+            return
+        is_active_session = runtime.get_instance().is_active_session
+        with self._lock:
+            for session_id in list(self._sessions):
+                if not is_active_session(session_id):
+                    del self._sessions[session_id]
+
+    @staticmethod
+    def get_owned_frames(state, shared_ids: set[int]) -> dict[str, pd.DataFrame]:
+        # The session's DataFrames that are not shared through a dataset cache
+        return {
+            key: value
+            for key, value in state.filtered_state.items()
+            if isinstance(value, pd.DataFrame) and id(value) not in shared_ids
+        }
+
+    def memory_usage(self) -> pd.DataFrame:
+        # Bytes of the DataFrames each session holds on its own (frames shared
+        # through the dataset caches are counted once, per dataset)
+        self.drop_inactive()
+        shared_ids = get_shared_frame_ids()
+        with self._lock:
+            sessions = list(self._sessions.items())
+        now = time.monotonic()
+        rows = []
+        for session_id, (state, last_active) in sessions:
+            frames = self.get_owned_frames(state, shared_ids).values()
+            rows.append(
+                {
+                    "session": session_id,
+                    "idle_seconds": int(now - last_active),
+                    "frames": len(frames),
+                    "bytes": sum(get_memory_usage(df) for df in frames),
+                }
+            )
+        return pd.DataFrame(
+            rows, columns=["session", "idle_seconds", "frames", "bytes"]
+        )
+
+    def evict_idle(self, budget_bytes: int, idle_timeout: int) -> list[str]:
+        # Drop the DataFrames of idle sessions, least recently active first,
+        # until all sessions together fit in the budget
+        usage = self.memory_usage()
+        total = usage["bytes"].sum()
+        evicted = []
+        idle = usage[usage["idle_seconds"] >= idle_timeout]
+        owners = idle[idle["bytes"] > 0]
+        for _, row in owners.sort_values("idle_seconds", ascending=False).iterrows():
+            if total <= budget_bytes:
+                break
+            with self._lock:
+                state, _ = self._sessions.pop(row["session"], (None, None))
+            if state is None:
+                continue
+            # Pages load their DataFrames again on the session's next rerun.
+            # Shared frames are left alone, dropping them would free nothing.
+            for key in self.get_owned_frames(state, get_shared_frame_ids()):
+                del state[key]
+            total -= row["bytes"]
+            evicted.append(row["session"])
+        # Stop tracking idle sessions that hold nothing; they register again
+        # on their next rerun
+        with self._lock:
+            for session_id in idle.loc[idle["bytes"] == 0, "session"]:
+                self._sessions.pop(session_id, None)
+        return evicted
+
+    def should_check(self, interval: int) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_check < interval:
+                return False
+            self._last_check = now
+            return True
+
+
+@st.cache_resource(show_spinner=False)
+def get_session_registry() -> SessionRegistry:
+    return SessionRegistry()
+
+
+def track_session_memory():
+    # Record this session's activity and periodically enforce the memory budget
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return
+    registry = get_session_registry()
+    registry.touch(ctx.session_id, ctx.session_state)
+    if registry.should_check(SESSION_MEMORY_CHECK_INTERVAL):
+        evicted = registry.evict_idle(
+            SESSION_MEMORY_BUDGET_MB * 2**20, SESSION_IDLE_TIMEOUT
+        )
+        if evicted:
+            print(f"Evicted the DataFrames of {len(evicted)} idle session(s)")
+
+
+def get_dataset_memory_usage() -> pd.DataFrame:
+    rows = [
+        {
+            "dataset": get_query_name(query),
+            "rows": len(dataset.df),
+            "bytes": get_memory_usage(dataset.df),
+        }
+        for query, dataset in list(get_loaded_datasets().items())
+    ]
+    return pd.DataFrame(rows, columns=["dataset", "rows", "bytes"])
+
+
+def show_memory_panel():
+    # Developer-only sidebar panel with the memory used by datasets and sessions
+    if os.getenv("DEVELOPMENT") != "TRUE":
+        return
+    datasets = get_dataset_memory_usage()
+    sessions = get_session_registry().memory_usage()
+    with st.sidebar.expander("🧠 Memory"):
+        st.caption(
+            f"Datasets: {datasets['bytes'].sum() / 2**20:.1f} MB, "
+            f"sessions: {sessions['bytes'].sum() / 2**20:.1f} MB "
+            f"of {SESSION_MEMORY_BUDGET_MB} MB"
+        )
+        st.dataframe(datasets, hide_index=True)
+        st.dataframe(sessions, hide_index=True)
+
+
+def build_values_clause(rows: list[dict]) -> tuple[str, str, dict]:
+    # Render rows as "(%(r0_a)s, %(r0_b)s), (%(r1_a)s, ...)" so the values are
+    # still sent as query parameters. Every row must have the same keys.
+    columns = list(rows[0].keys())
+    values = []
+    params = {}
+    for i, row in enumerate(rows):
+        placeholders = []
+        for col in columns:
+            params[f"r{i}_{col}"] = row[col]
+            placeholders.append(f"%(r{i}_{col})s")
+        values.append(f"({', '.join(placeholders)})")
+    return ", ".join(columns), ", ".join(values), params
 
-    # MAP page to job_id
-    page_to_id = {"ww-trends": os.getenv("WW_JOB_ID"), "mpox": os.getenv("MPOX_JOB_ID")}
 
-    url = f"{os.getenv("ADB_INSTANCE_NAME")}/api/2.2/jobs/run-now"
-    payload = {
+def build_in_clause(values: list, prefix: str) -> tuple[str, dict]:
+    # Render values as "%(prefix_0)s, %(prefix_1)s, ..." for an IN (...) list
+    params = {f"{prefix}_{i}": value for i, value in enumerate(values)}
+    return ", ".join(f"%({name})s" for name in params), params
+
+
+def execute_batch(cursor, query: str, rows: list[dict]):
+    # Run a batch template (UPDATE_*_QUERY, INSERT_NEW_LOGS_QUERY) with one statement
+    # per WRITE_BATCH_SIZE rows instead of one statement per row
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        columns, values, params = build_values_clause(
+            rows[start : start + WRITE_BATCH_SIZE]
+        )
+        cursor.execute(query.format(columns=columns, values=values), params)
+
+
+def filter_sites_and_measures(
+    df: pd.DataFrame,
+    site_column: str,
+    selected_sites: list[str],
+    selected_measures: list[str],
+) -> pd.DataFrame:
+    # Filter on the selected measures, and on the selected sites unless
+    # "All Sites" is selected
+    mask = df["measure"].isin(selected_measures)
+    if "All Sites" not in selected_sites:
+        mask &= df[site_column].isin(selected_sites)
+    return df[mask]
+
+
+def get_changed_indices(
+    old_data: pd.DataFrame, new_data: pd.DataFrame, columns: list[str]
+) -> pd.Index:
+    # Index labels of the rows where any of the given columns was actually changed
+    old_values = old_data[columns]
+    new_values = new_data.loc[old_data.index, columns]
+    unchanged = (old_values == new_values) | (old_values.isna() & new_values.isna())
+    return old_data.index[~unchanged.all(axis=1)]
+
+
+def build_log_filters(
+    user: str = None,
+    page: str = None,
+    measure: str = None,
+    start_date=None,
+    end_date=None,
+) -> tuple[str, dict]:
+    # Turn the admin page filters into a parameterized WHERE clause for
+    # FETCH_LOG_QUERY and COUNT_LOG_QUERY. Empty filters are ignored.
+    clauses = []
+    params = {}
+    if user:
+        clauses.append("User = %(filter_user)s")
+        params["filter_user"] = user
+    if page:
+        clauses.append("Page = %(filter_page)s")
+        params["filter_page"] = page
+    if measure:
+        clauses.append("Measure = %(filter_measure)s")
+        params["filter_measure"] = measure
+    if start_date:
+        clauses.append("Time >= CAST(%(filter_start_date)s AS DATE)")
+        params["filter_start_date"] = str(start_date)
+    if end_date:
+        clauses.append("Time < DATE_ADD(CAST(%(filter_end_date)s AS DATE), 1)")
+        params["filter_end_date"] = str(end_date)
+    return " AND ".join(clauses) or "TRUE", params
+
+
+def build_log_keyset(after: tuple[str, str] = None) -> tuple[str, dict]:
+    # Keyset condition for the page that follows the (Time, RowKey) of the last
+    # entry of the previous page, or no condition for the first page
+    if after is None:
+        return "TRUE", {}
+    return (
+        "(SortTime < CAST(%(after_time)s AS TIMESTAMP) OR "
+        "(SortTime = CAST(%(after_time)s AS TIMESTAMP) AND RowKey < %(after_key)s))",
+        {"after_time": after[0], "after_key": after[1]},
+    )
+
+
+class JobStatus:
+    """The state of one triggered publishing job, updated by the job worker."""
+
+    def __init__(self, page: str):
+        self._lock = threading.Lock()
+        self.page = page
+        self.state = JOB_QUEUED
+        self.run_id = None
+        self.message = None
+        self.updated_at = datetime.now()
+
+    def set(self, state: str, run_id: int = None, message: str = None):
+        with self._lock:
+            self.state = state
+            self.run_id = run_id or self.run_id
+            self.message = message
+            self.updated_at = datetime.now()
+
+    @property
+    def active(self) -> bool:
+        return self.state in (JOB_QUEUED, JOB_RUNNING)
+
+
+class JobStatuses:
+    """The latest JobStatus of every page, shared by all sessions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+
+    def get(self, page: str) -> JobStatus:
+        with self._lock:
+            return self._latest.get(page)
+
+    def add(self, status: JobStatus):
+        with self._lock:
+            self._latest[status.page] = status
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_statuses() -> JobStatuses:
+    return JobStatuses()
+
+
+@st.cache_resource(show_spinner=False)
+def get_jobs_session() -> requests.Session:
+    # One keep-alive session for every jobs API call. run-now is retried too,
+    # which is safe because every trigger carries an idempotency token.
+    retry = Retry(
+        total=JOB_API_RETRIES,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    session.headers.update(
+        {
+            "Authorization": f"Bearer {os.getenv('ADB_API_KEY')}",
+            "Content-Type": "application/json",
+        }
+    )
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="jobs")
+
+
+def get_jobs_api_url(endpoint: str) -> str:
+    return f"{os.getenv("ADB_INSTANCE_NAME")}/api/2.2/jobs/{endpoint}"
+
+
+def run_job(status: JobStatus, payload: dict):
+    # Trigger the job, then poll the run until it reaches a terminal state
+    session = get_jobs_session()
+    try:
+        response = session.post(
+            get_jobs_api_url("run-now"), json=payload, timeout=JOB_API_TIMEOUT
+        )
+        response.raise_for_status()
+        run_id = response.json()["run_id"]
+        status.set(JOB_RUNNING, run_id=run_id)
+        print(f"Triggered {status.page} job run {run_id}")
+
+        deadline = time.monotonic() + JOB_STATUS_POLL_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(JOB_STATUS_POLL_INTERVAL)
+            response = session.get(
+                get_jobs_api_url("runs/get"),
+                params={"run_id": run_id},
+                timeout=JOB_API_TIMEOUT,
+            )
+            response.raise_for_status()
+            state = response.json().get("state", {})
+            if state.get("life_cycle_state") in (
+                "TERMINATED",
+                "SKIPPED",
+                "INTERNAL_ERROR",
+            ):
+                if state.get("result_state") == "SUCCESS":
+                    status.set(JOB_SUCCEEDED)
+                else:
+                    status.set(JOB_FAILED, message=state.get("state_message"))
+                print(f"{status.page} job run {run_id} finished: {status.state}")
+                return
+        status.set(JOB_FAILED, message="Timed out waiting for the job run to finish")
+    except Exception as e:
+        status.set(JOB_FAILED, message=str(e))
+        print(f"{status.page} job run failed: {e}")
+
+
+def build_job_payload(page: str, change_sets: list[tuple[str, list[dict]]]) -> dict:
+    # One run-now payload for buffered (user_email, log_entries) change sets of
+    # a single editor: user_email is the one address the job notifies
+    page_to_id = {"ww-trends": os.getenv("WW_JOB_ID"), "mpox": os.getenv("MPOX_JOB_ID")}
+    changes = [entry for _, log_entries in change_sets for entry in log_entries]
+    return {
         "job_id": page_to_id[page],
+        "idempotency_token": str(uuid.uuid4()),
         "job_parameters": {
-            "user_email": get_username(),
-            "changes": json.dumps(log_entries),
+            "user_email": change_sets[0][0],
+            "changes": json.dumps(changes),
         },
     }
-    headers = {
-        "Authorization": f"Bearer {os.getenv('ADB_API_KEY')}",
-        "Content-Type": "application/json",
-    }
 
-    # Send the POST request
-    response = requests.post(url, json=payload, headers=headers)
 
-    # Optionally, handle possible HTTP errors
-    response.raise_for_status()
+class JobScheduler:
+    """Coalesces the publishing jobs of each page.
+
+    Change sets submitted within ``window`` seconds of the first pending one
+    are merged into a single run per editor, since the job notifies a single
+    ``user_email``. A page never has two runs in flight: changes submitted
+    while a run is active, and other editors' changes, wait for it to finish.
+    """
+
+    def __init__(self, window: int, executor: ThreadPoolExecutor):
+        self.window = window
+        self.executor = executor
+        self._lock = threading.Lock()
+        # page -> (JobStatus, [(user_email, log_entries), ...]) not yet launched
+        self._pending = {}
+        # page -> flush timer, and page -> status of the launched run
+        self._timers = {}
+        self._running = {}
+
+    def submit(self, page: str, user_email: str, log_entries: list[dict]) -> JobStatus:
+        with self._lock:
+            if page not in self._pending:
+                self._pending[page] = (JobStatus(page), [])
+            status, change_sets = self._pending[page]
+            change_sets.append((user_email, log_entries or []))
+            status.set(
+                JOB_QUEUED, message=f"{len(change_sets)} change set(s) waiting"
+            )
+            self._schedule(page, self.window)
+        return status
+
+    def _schedule(self, page: str, delay: float):
+        # Must be called with the lock held
+        if page in self._timers:
+            return
+        timer = threading.Timer(delay, self._flush, args=(page,))
+        timer.daemon = True
+        self._timers[page] = timer
+        timer.start()
+
+    def _flush(self, page: str):
+        with self._lock:
+            del self._timers[page]
+            running = self._running.get(page)
+            if page not in self._pending or (running is not None and running.active):
+                # _run() schedules the pending changes once the active run ends
+                return
+            status, change_sets = self._pending.pop(page)
+            user_email = change_sets[0][0]
+            waiting = [c for c in change_sets if c[0] != user_email]
+            change_sets = [c for c in change_sets if c[0] == user_email]
+            if waiting:
+                # Other editors' changes get the page's next run
+                waiting_status = JobStatus(page)
+                waiting_status.set(
+                    JOB_QUEUED, message=f"{len(waiting)} change set(s) waiting"
+                )
+                self._pending[page] = (waiting_status, waiting)
+            self._running[page] = status
+        get_job_statuses().add(status)
+        self.executor.submit(self._run, page, status, change_sets)
+
+    def _run(self, page: str, status: JobStatus, change_sets: list):
+        print(f"Publishing {len(change_sets)} coalesced change set(s) for {page}")
+        run_job(status, build_job_payload(page, change_sets))
+        with self._lock:
+            if page in self._pending:
+                self._schedule(page, 0)
+
+
+@st.cache_resource(show_spinner=False)
+def get_job_scheduler() -> JobScheduler:
+    return JobScheduler(JOB_DEBOUNCE_SECONDS, get_job_executor())
+
+
+def trigger_job_run(
+    page: str, log_entries: list[dict] = None, user_email: str = None
+) -> JobStatus:
+    # Queues the changes for the page's publishing job and returns the status of
+    # the run that will include them, so the caller never waits on the jobs API.
+    # Background callers pass the submitting user's email.
+    # do not run job if in development mode
+    if os.getenv("DEVELOPMENT") == "TRUE":
+        status = JobStatus(page)
+        status.set(JOB_SKIPPED, message="Jobs are not run in development mode")
+    else:
+        status = get_job_scheduler().submit(
+            page, user_email or get_username(), log_entries
+        )
+    get_job_statuses().add(status)
+    return status
+
 
-    return response.status_code
+def render_job_status(page: str):
+    status = get_job_statuses().get(page)
+    if status is None:
+        return
+    time_str = status.updated_at.strftime("%H:%M:%S")
+    if status.state == JOB_QUEUED:
+        st.info(f"⏳ Your changes will be published shortly ({status.message}).")
+    elif status.state == JOB_RUNNING:
+        st.info(f"⏳ Publishing your changes (job run {status.run_id})...")
+    elif status.state == JOB_SUCCEEDED:
+        st.success(f"✅ Changes published at {time_str}.")
+    elif status.state == JOB_FAILED:
+        st.error(f"⚠️ Publishing failed at {time_str}: {status.message}")
+
+
+@st.fragment(run_every=5)
+def render_active_job_status(page: str):
+    # Re-renders on its own while the job runs, without rerunning the page
+    render_job_status(page)
+
+
+def show_job_status(page: str):
+    # Publishing status of the page's latest job run, shared by every session
+    status = get_job_statuses().get(page)
+    if status is not None and status.active:
+        render_active_job_status(page)
+    else:
+        render_job_status(page)
+
+
+def encode_queue_value(value):
+    # json.dumps() default: dates are tagged so they are bound with their type again
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Cannot queue a value of type {type(value).__name__}")
+
+
+def decode_queue_value(obj: dict):
+    # json.loads() object_hook, the inverse of encode_queue_value()
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    return obj
+
+
+class WriteQueue:
+    """Durable local queue of editor submissions, in SQLite (WAL mode).
+
+    A submission (its MERGE rows and log entries) is committed in a single
+    transaction under a unique idempotency key, so it survives a failed
+    warehouse call or an app restart until the flusher has applied it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Set on every enqueue so the flusher does not wait for its next interval
+        self.wakeup = threading.Event()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(CREATE_WRITE_QUEUE_QUERY)
+            # Queues created before submissions were claimed
+            columns = {
+                row["name"] for row in conn.execute("PRAGMA table_info(submissions)")
+            }
+            for column in ("claimed_by TEXT", "lease_expires_at REAL"):
+                if column.split()[0] not in columns:
+                    conn.execute(f"ALTER TABLE submissions ADD COLUMN {column}")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            # Commits on success and rolls back on error
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def enqueue(
+        self,
+        idempotency_key: str,
+        page: str,
+        user: str,
+        updates: list[dict],
+        log_entries: list[dict],
+    ) -> bool:
+        # Returns False if a submission with this key was already queued
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                INSERT OR IGNORE INTO submissions (
+                    idempotency_key, page, user, updates, log_entries,
+                    status, created_at, next_attempt_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    idempotency_key,
+                    page,
+                    user,
+                    json.dumps(updates, default=encode_queue_value),
+                    json.dumps(log_entries, default=encode_queue_value),
+                    WRITE_PENDING,
+                    now,
+                    now,
+                ),
+            )
+        self.wakeup.set()
+        return cursor.rowcount == 1
+
+    def get_due(self, limit: int) -> list[dict]:
+        # Claim the pending submissions whose retry backoff has passed, oldest
+        # first, and those whose claim has expired. A page's submissions are
+        # applied strictly in order, so none are due while an earlier one of
+        # the page is backing off, being applied or has failed. Selected and
+        # claimed in one write transaction, so no two flushers get the same.
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                """
+                SELECT * FROM submissions AS submission
+                WHERE (
+                        (status = ? AND next_attempt_at <= ?)
+                        OR (status = ? AND lease_expires_at <= ?)
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1 FROM submissions AS earlier
+                        WHERE earlier.page = submission.page
+                            AND earlier.id < submission.id
+                            AND (
+                                earlier.status = ?
+                                OR (earlier.status = ? AND earlier.next_attempt_at > ?)
+                                OR (earlier.status = ? AND earlier.lease_expires_at > ?)
+                            )
+                    )
+                ORDER BY id
+                LIMIT ?
+                """,
+                (
+                    WRITE_PENDING,
+                    now,
+                    WRITE_APPLYING,
+                    now,
+                    WRITE_FAILED,
+                    WRITE_PENDING,
+                    now,
+                    WRITE_APPLYING,
+                    now,
+                    limit,
+                ),
+            ).fetchall()
+            conn.executemany(
+                """
+                UPDATE submissions
+                SET status = ?, claimed_by = ?, lease_expires_at = ?
+                WHERE id = ?
+                """,
+                [
+                    (WRITE_APPLYING, claim, now + WRITE_QUEUE_LEASE, row["id"])
+                    for row in rows
+                ],
+            )
+        submissions = []
+        for row in rows:
+            submission = dict(row, claimed_by=claim)
+            for column in ("updates", "log_entries"):
+                submission[column] = json.loads(
+                    submission[column], object_hook=decode_queue_value
+                )
+            submissions.append(submission)
+        return submissions
+
+    def mark_applied(self, submissions: list[dict]):
+        # Only submissions still claimed by this flusher are updated
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                UPDATE submissions
+                SET status = ?, applied_at = ?, claimed_by = NULL, lease_expires_at = NULL
+                WHERE id = ? AND claimed_by = ?
+                """,
+                [
+                    (WRITE_APPLIED, now, submission["id"], submission["claimed_by"])
+                    for submission in submissions
+                ],
+            )
+            conn.execute(
+                "DELETE FROM submissions WHERE status = ? AND applied_at < ?",
+                (WRITE_APPLIED, now - WRITE_QUEUE_RETENTION),
+            )
+
+    def release(self, submissions: list[dict]):
+        # Hand claimed submissions that were not attempted back to the queue
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                UPDATE submissions
+                SET status = ?, claimed_by = NULL, lease_expires_at = NULL
+                WHERE id = ? AND claimed_by = ?
+                """,
+                [
+                    (WRITE_PENDING, submission["id"], submission["claimed_by"])
+                    for submission in submissions
+                ],
+            )
+
+    def record_failure(self, submission: dict, error: str) -> bool:
+        # Schedule the next attempt with exponential backoff. Returns True once
+        # the submission has used up its attempts and is marked failed.
+        attempts = submission["attempts"] + 1
+        failed = attempts >= WRITE_QUEUE_MAX_ATTEMPTS
+        backoff = min(WRITE_QUEUE_FLUSH_INTERVAL * 2**attempts, WRITE_QUEUE_MAX_BACKOFF)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                UPDATE submissions
+                SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?,
+                    claimed_by = NULL, lease_expires_at = NULL
+                WHERE id = ? AND claimed_by = ?
+                """,
+                (
+                    WRITE_FAILED if failed else WRITE_PENDING,
+                    attempts,
+                    error,
+                    time.time() + backoff,
+                    submission["id"],
+                    submission["claimed_by"],
+                ),
+            )
+        return failed
+
+    def retry_failed(self, page: str) -> int:
+        with self._connect() as conn:
+            cursor = conn.execute(
+                """
+                UPDATE submissions
+                SET status = ?, attempts = 0, next_attempt_at = ?
+                WHERE status = ? AND page = ?
+                """,
+                (WRITE_PENDING, time.time(), WRITE_FAILED, page),
+            )
+        self.wakeup.set()
+        return cursor.rowcount
+
+    def get_status(self, page: str) -> dict:
+        # Number of pending and failed submissions of the page, the latest
+        # error and when a submission was last applied
+        with self._connect() as conn:
+            counts = dict(
+                conn.execute(
+                    """
+                    SELECT status, COUNT(*) FROM submissions
+                    WHERE page = ? AND status != ?
+                    GROUP BY status
+                    """,
+                    (page, WRITE_APPLIED),
+                ).fetchall()
+            )
+            last_error = conn.execute(
+                """
+                SELECT last_error FROM submissions
+                WHERE page = ? AND status != ? AND last_error IS NOT NULL
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (page, WRITE_APPLIED),
+            ).fetchone()
+            applied_at = conn.execute(
+                "SELECT MAX(applied_at) FROM submissions WHERE page = ?", (page,)
+            ).fetchone()[0]
+        return {
+            "pending": counts.get(WRITE_PENDING, 0) + counts.get(WRITE_APPLYING, 0),
+            "failed": counts.get(WRITE_FAILED, 0),
+            "last_error": last_error[0] if last_error else None,
+            "applied_at": datetime.fromtimestamp(applied_at) if applied_at else None,
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def get_write_queue() -> WriteQueue:
+    return WriteQueue(WRITE_QUEUE_PATH)
+
+
+def start_submission(page: str):
+    # Called when a page's edit dialog is opened: every submit of that dialog
+    # (e.g. a double-clicked Submit) is queued under the same idempotency key
+    st.session_state[f"submission_key_{page}"] = str(uuid.uuid4())
+
+
+def submit_changes(page: str, updates: list[dict], log_entries: list[dict]) -> str:
+    # Durably queue the edits of one dialog submit and return right away; the
+    # background flusher writes them to the warehouse and publishes them. A
+    # repeated submit of the same dialog is ignored.
+    idempotency_key = st.session_state.get(f"submission_key_{page}") or str(
+        uuid.uuid4()
+    )
+    get_write_queue().enqueue(
+        idempotency_key, page, get_username(), updates, log_entries
+    )
+    return idempotency_key
+
+
+def apply_submissions(page: str, submissions: list[dict]):
+    # Write a batch of queued submissions of one page with one MERGE for the
+    # edited rows and one for the log entries. Both are safe to repeat: the
+    # MERGE sets absolute values and log entries are matched on their LogID.
+    query, value_param, _, _ = WRITE_TARGETS[page]
+    updates = {}
+    for submission in submissions:
+        for row in submission["updates"]:
+            # A row edited by several submissions gets its latest value
+            key = tuple((k, v) for k, v in row.items() if k != value_param)
+            updates.pop(key, None)
+            updates[key] = row
+    log_entries = [
+        entry for submission in submissions for entry in submission["log_entries"]
+    ]
+    with get_cursor() as cursor:
+        execute_batch(cursor, query, list(updates.values()))
+        execute_batch(cursor, INSERT_NEW_LOGS_QUERY, log_entries)
+
+
+def discard_unsaved_edits(page: str):
+    # Read the page dataset again, dropping the edits patched into it that
+    # could not be saved (a snapshot may hold them too, so it is not reused)
+    query = WRITE_TARGETS[page][2]
+    try:
+        reload_dataset(query, load_dataset(query))
+    except Exception as e:
+        print(f"Could not reload the {page} dataset: {e}")
+        invalidate_dataset(query)
+
+
+def flush_write_queue(queue: WriteQueue) -> int:
+    # Apply the due submissions page by page and return how many were applied.
+    # When a batch fails, its submissions are retried one at a time in order,
+    # stopping at the first failure: a later edit of a row must never be
+    # overwritten by an earlier one applied after it.
+    by_page = {}
+    for submission in queue.get_due(WRITE_BATCH_SIZE):
+        by_page.setdefault(submission["page"], []).append(submission)
+
+    applied = []
+    for page, submissions in by_page.items():
+        try:
+            apply_submissions(page, submissions)
+            applied += submissions
+        except Exception as e:
+            print(f"Could not write {len(submissions)} {page} submission(s): {e}")
+            if len(submissions) == 1:
+                if queue.record_failure(submissions[0], str(e)):
+                    discard_unsaved_edits(page)
+                continue
+            for i, submission in enumerate(submissions):
+                try:
+                    apply_submissions(page, [submission])
+                    applied.append(submission)
+                except Exception as e:
+                    if queue.record_failure(submission, str(e)):
+                        discard_unsaved_edits(page)
+                    queue.release(submissions[i + 1 :])
+                    break
+    if not applied:
+        return 0
+
+    queue.mark_applied(applied)
+    print(f"Wrote {len(applied)} queued submission(s) to the warehouse")
+    for submission in applied:
+        if WRITE_TARGETS[submission["page"]][3] and submission["log_entries"]:
+            trigger_job_run(
+                submission["page"], submission["log_entries"], submission["user"]
+            )
+    if SERVER_SIDE_FILTERS and any(s["page"] == "large-jumps" for s in applied):
+        # Filtered large-jumps results are loaded again with the edits
+        invalidate_filtered_datasets()
+    return len(applied)
+
+
+def flush_write_queue_periodically(queue: WriteQueue):
+    while True:
+        queue.wakeup.wait(WRITE_QUEUE_FLUSH_INTERVAL)
+        queue.wakeup.clear()
+        try:
+            flush_write_queue(queue)
+        except Exception as e:
+            print(f"Write queue flush failed: {e}")
+
+
+@st.cache_resource(show_spinner=False)
+def start_write_queue_flusher() -> bool:
+    # Runs once per process, starting with anything left over from a restart
+    thread = threading.Thread(
+        target=flush_write_queue_periodically, args=(get_write_queue(),), daemon=True
+    )
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+    return True
+
+
+def render_write_queue_status(page: str):
+    queue = get_write_queue()
+    status = queue.get_status(page)
+    if status["pending"]:
+        message = f"💾 Saving {status['pending']} submission(s) to the warehouse..."
+        if status["last_error"]:
+            message += f" Retrying after an error: {status['last_error']}"
+        st.info(message)
+    if status["failed"]:
+        st.error(
+            f"⚠️ {status['failed']} submission(s) could not be saved: "
+            f"{status['last_error']}. Later submissions wait until they are saved."
+        )
+        if can_user_edit() and st.button("Retry saving", key=f"retry_writes_{page}"):
+            queue.retry_failed(page)
+            st.rerun()
+
+
+@st.fragment(run_every=5)
+def render_active_write_queue_status(page: str):
+    # Re-renders on its own while submissions are being saved
+    render_write_queue_status(page)
+
+
+def show_write_queue_status(page: str):
+    # Progress of the page's queued submissions, shared by every session
+    if get_write_queue().get_status(page)["pending"]:
+        render_active_write_queue_status(page)
+    else:
+        render_write_queue_status(page)
 
 
 def get_user_info() -> dict:
@@ -276,35 +2723,54 @@ def can_user_edit():
     return st.session_state.is_editor
 
 
-def get_log_entry(
-    old_data: pd.DataFrame, new_data: pd.DataFrame, page: str
-) -> dict[str, str]:
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-    log_entry = {
-        "User": get_username(),
-        "Time": current_time,
-        "Page": page,
-        "Location": old_data.get("Location", "N/A"),
-        "SiteID": old_data.get("siteID", "N/A"),
-        "Measure": old_data.get("measure", "mpox" if page == "Mpox Trends" else "N/A"),
-        "EpiWeek": (
-            str(int(old_data.get("EpiWeek"))) if page == "Mpox Trends" else "N/A"
-        ),
-        "EpiYear": (
-            str(int(old_data.get("EpiYear"))) if page == "Mpox Trends" else "N/A"
-        ),
-        "ChangedColumn": "N/A",
-        "OldValue": "N/A",
-        "NewValue": "N/A",
-    }
+def build_change_set(
+    old_data: pd.DataFrame,
+    new_data: pd.DataFrame,
+    page: str,
+    columns: list[str] = None,
+) -> list[dict[str, str]]:
+    # One log entry per changed cell of the selection (default: every column),
+    # compared in a single vectorized pass. All entries of a submission share
+    # the same Time, and every value is a string so the entries can be sent
+    # to INSERT_NEW_LOGS_QUERY and the publishing job's changes as they are.
+    columns = columns or list(old_data.columns)
+    old_values = old_data[columns].to_numpy(dtype=object)
+    new_values = new_data.loc[old_data.index, columns].to_numpy(dtype=object)
+    unchanged = (old_values == new_values) | (pd.isna(old_values) & pd.isna(new_values))
+    row_pos, col_pos = np.nonzero(~unchanged)
+    rows = old_data.iloc[row_pos]
+    n_changes = len(row_pos)
 
-    # Note this assumes at most only one column can be changed
-    for col in old_data.index:
-        if old_data[col] != new_data[col]:
-            log_entry["ChangedColumn"] = col
-            log_entry["OldValue"] = str(old_data[col])
-            log_entry["NewValue"] = str(new_data[col])
+    def context(column: str, default: str) -> np.ndarray:
+        # The row's value of column, or default when the page has no such column
+        if column not in rows:
+            return np.full(n_changes, default, dtype=object)
+        return rows[column].astype(str).to_numpy()
 
-    # return log entry
-    return log_entry
+    is_mpox = page == "Mpox Trends"
+    change_set = pd.DataFrame(
+        {
+            "LogID": [str(uuid.uuid4()) for _ in range(n_changes)],
+            "User": get_username(),
+            "Time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "Page": page,
+            "Location": context("Location", "N/A"),
+            "SiteID": context("siteID", "N/A"),
+            "Measure": context("measure", "mpox" if is_mpox else "N/A"),
+            "EpiWeek": (
+                rows["EpiWeek"].astype(int).astype(str).to_numpy()
+                if is_mpox
+                else "N/A"
+            ),
+            "EpiYear": (
+                rows["EpiYear"].astype(int).astype(str).to_numpy()
+                if is_mpox
+                else "N/A"
+            ),
+            "ChangedColumn": np.asarray(columns, dtype=object)[col_pos],
+            "OldValue": old_values[row_pos, col_pos].astype(str),
+            "NewValue": new_values[row_pos, col_pos].astype(str),
+        },
+        index=range(n_changes),
+    )
+    return change_set.to_dict("records")
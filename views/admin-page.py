@@ -1,8 +1,55 @@
 import os
 import streamlit as st
-import pandas as pd
 
-from utils import FETCH_LOG_QUERY, DELETE_LOG_QUERY, get_cursor, get_user_info
+from utils import (
+    COUNT_LOG_QUERY,
+    FETCH_LOG_QUERY,
+    DELETE_LOG_QUERY,
+    DELETE_LOGS_BY_ID_QUERY,
+    LOG_PAGE_SIZE,
+    build_in_clause,
+    build_log_filters,
+    build_log_keyset,
+    fetch_dataframe,
+    get_cursor,
+    get_user_info,
+    show_warehouse_status,
+    timed_span,
+)
+
+LOG_PAGES = ["Water Wastewater Trends", "Mpox Trends", "Large Jumps"]
+
+
+def get_log_filters() -> dict:
+    left, middle, right, date_col = st.columns(4)
+    user = left.text_input("Filter by user:")
+    page = middle.selectbox("Filter by page:", LOG_PAGES, index=None)
+    measure = right.text_input("Filter by measure:")
+    date_range = date_col.date_input("Filter by date range:", value=())
+    return {
+        "user": user.strip(),
+        "page": page,
+        "measure": measure.strip(),
+        "start_date": date_range[0] if len(date_range) > 0 else None,
+        "end_date": date_range[1] if len(date_range) > 1 else None,
+    }
+
+
+def fetch_log_page(filters: dict, after: tuple[str, str] = None):
+    filters_sql, filter_params = build_log_filters(**filters)
+    keyset_sql, keyset_params = build_log_keyset(after)
+    # Cancelled if the user moves on before the page of logs has loaded
+    with get_cursor(bind_session=True) as cursor:
+        cursor.execute(
+            FETCH_LOG_QUERY.format(
+                filters=filters_sql, keyset=keyset_sql, limit=LOG_PAGE_SIZE
+            ),
+            {**filter_params, **keyset_params},
+        )
+        df_logs = fetch_dataframe(cursor)
+        cursor.execute(COUNT_LOG_QUERY.format(filters=filters_sql), filter_params)
+        total = cursor.fetchone()[0]
+    return df_logs, total
 
 
 def app():
@@ -15,14 +62,23 @@ def app():
         st.error("Access denied. You do not have permission to view this page.")
         return
 
+    filters = get_log_filters()
+    # Go back to the first page whenever the filters change
+    if st.session_state.get("log_filters") != filters:
+        st.session_state.log_filters = filters
+        st.session_state.log_page_keys = []
+
+    # The (Time, RowKey) of the last entry of every page before the current one
+    page_keys = st.session_state.log_page_keys
+    show_warehouse_status()
     with st.spinner(
         "If the data cluster is cold starting, this may take up to 5 minutes",
         show_time=True,
     ):
-        with get_cursor() as cursor:
-            cursor.execute(FETCH_LOG_QUERY)
-            rows = [row.asDict() for row in cursor.fetchall()]
-            st.session_state.df_logs = pd.DataFrame(rows)
+        with timed_span("fetch"):
+            st.session_state.df_logs, total = fetch_log_page(
+                filters, page_keys[-1] if page_keys else None
+            )
 
     st.write(
         "Select one or more rows below and click the delete button to remove the entry(ies)."
@@ -33,14 +89,38 @@ def app():
         selection_mode="multi-row",
         on_select="rerun",
         hide_index=True,
+        column_config={"LogID": None, "RowKey": None},
     )
 
+    previous_col, info_col, next_col = st.columns([1, 4, 1])
+    info_col.caption(
+        f"Page {len(page_keys) + 1} of {max(1, -(-total // LOG_PAGE_SIZE))} "
+        f"({total} entries)"
+    )
+    if previous_col.button("Previous", disabled=not page_keys):
+        page_keys.pop()
+        st.rerun()
+    if next_col.button(
+        "Next", disabled=(len(page_keys) + 1) * LOG_PAGE_SIZE >= total
+    ):
+        last_row = st.session_state.df_logs.iloc[-1]
+        page_keys.append((last_row["Time"], last_row["RowKey"]))
+        st.rerun()
+
     selection = selected_rows.selection.get("rows", [])
 
     if selection and st.button("Delete Selected Row(s)", type="primary"):
+        selected_df = st.session_state.df_logs.iloc[selection]
+        has_id = selected_df["LogID"].notna()
         with get_cursor() as cursor:
-            for idx in selection:
-                row = st.session_state.df_logs.iloc[idx]
+            # Delete every selected entry that has a LogID in one statement
+            if has_id.any():
+                ids, params = build_in_clause(
+                    list(selected_df.loc[has_id, "LogID"]), "log_id"
+                )
+                cursor.execute(DELETE_LOGS_BY_ID_QUERY.format(ids=ids), params)
+            # Legacy entries without a LogID are matched on all of their columns
+            for _, row in selected_df[~has_id].iterrows():
                 cursor.execute(
                     DELETE_LOG_QUERY,
                     {
@@ -57,10 +137,7 @@ def app():
                         "NewValue": row["NewValue"],
                     },
                 )
-        # Remove the deleted rows from the local DataFrame
-        st.session_state.df_logs = st.session_state.df_logs.drop(
-            st.session_state.df_logs.index[selection]
-        ).reset_index(drop=True)
+        # The current page is fetched again on the rerun
         # st.success("Selected row(s) have been deleted.",)
         st.rerun()
 
@@ -4,57 +4,94 @@ import plotly.graph_objects as go
 
 from utils import (
     FETCH_LARGE_JUMPS_QUERY,
-    UPDATE_LARGE_JUMPS_QUERY,
-    FETCH_AFTER_LARGE_JUMP_QUERY,
-    FETCH_BEFORE_LARGE_JUMP_QUERY,
-    INSERT_LOG_QUERY,
+    FETCH_LARGE_JUMP_HISTORY_QUERY,
+    JUMP_HISTORY_CACHE_MAX_ENTRIES,
+    SERVER_SIDE_FILTERS,
+    CountingLRUCache,
+    build_change_set,
+    build_values_clause,
     can_user_edit,
+    fetch_dataframe,
+    fetch_dataset,
+    fetch_distinct_values,
+    fetch_filtered_dataset,
+    get_changed_indices,
+    get_counting_caches,
     get_cursor,
-    get_log_entry,
+    is_dataset_live,
+    show_refresh_button,
+    show_warehouse_status,
+    show_write_queue_status,
+    start_submission,
+    submit_changes,
     get_username,
+    timed_fragment,
+    timed_span,
 )
 
 USER_CAN_EDIT = can_user_edit()
 
 
-def create_jump_plot(row, log_scale):
-    # Prepare lists for the historical points (before previousObsDT)
-    x_hist, y_hist = [], []
+def get_jump_key(row) -> tuple:
+    return (row["siteID"], row["measure"], row["previousObsDT"], row["latestObsDT"])
 
-    # Fetch the past observations
-    with get_cursor() as cursor:
-        cursor.execute(
-            FETCH_BEFORE_LARGE_JUMP_QUERY,
+
+@st.cache_resource(show_spinner=False)
+def get_jump_history_cache() -> CountingLRUCache:
+    # Jump histories never change once observed, so they are shared by every
+    # session and only evicted when the cache is full
+    cache = CountingLRUCache(JUMP_HISTORY_CACHE_MAX_ENTRIES)
+    get_counting_caches()["jump histories"] = cache
+    return cache
+
+
+def fetch_jump_histories(jumps: pd.DataFrame) -> dict[tuple, pd.DataFrame]:
+    # Look up the before/after context of every selected jump, keyed by
+    # get_jump_key(). Jumps missing from the cache are fetched with one query.
+    cache = get_jump_history_cache()
+    histories = {}
+    keys = []
+    for key in dict.fromkeys(get_jump_key(row) for _, row in jumps.iterrows()):
+        history = cache.get(key)
+        if history is None:
+            keys.append(key)
+        else:
+            histories[key] = history
+    if not keys:
+        return histories
+
+    columns, values, params = build_values_clause(
+        [
             {
-                "siteID": row["siteID"],
-                "Measure": row["measure"],
-                "previousObsDT": row["previousObsDT"],
-            },
-        )
-        hist_rows = cursor.fetchall()
-    # The query returns points in descending order; reverse to chronological order.
-    hist_rows = list(reversed(hist_rows))
-    for hist_row in hist_rows:
-        x_hist.append(hist_row["collDT"])
-        y_hist.append(hist_row["valavg"])
-
-    # Fetch the future observation if it exists
-    with get_cursor() as cursor:
+                "jump_idx": jump_idx,
+                "site_id": key[0],
+                "measure": key[1],
+                "previous_obs_dt": key[2],
+                "latest_obs_dt": key[3],
+            }
+            for jump_idx, key in enumerate(keys)
+        ]
+    )
+    # Cancelled if the user changes the selection before the histories load
+    with get_cursor(bind_session=True) as cursor:
         cursor.execute(
-            FETCH_AFTER_LARGE_JUMP_QUERY,
-            {
-                "siteID": row["siteID"],
-                "Measure": row["measure"],
-                "latestObsDT": row["latestObsDT"],
-            },
+            FETCH_LARGE_JUMP_HISTORY_QUERY.format(columns=columns, values=values),
+            params,
         )
-        fut_row = cursor.fetchone()
-    # Correctly assign fut_row values if available
-    if fut_row is not None:
-        x_fut = [fut_row["collDT"]]
-        y_fut = [fut_row["valavg"]]
-    else:
-        x_fut, y_fut = [], []
+        history = fetch_dataframe(cursor)
+
+    for jump_idx, key in enumerate(keys):
+        histories[key] = history[history["jump_idx"] == jump_idx]
+        cache.set(key, histories[key])
+    return histories
+
+
+def create_jump_plot(row, log_scale, history: pd.DataFrame):
+    # The history is returned in chronological order
+    before = history[history["position"] == "before"]
+    after = history[history["position"] == "after"]
+    x_hist, y_hist = list(before["collDT"]), list(before["valavg"])
+    x_fut, y_fut = list(after["collDT"]), list(after["valavg"])
 
     # Prepare the jump segment points: previousObs and latestObs
     x_jump = [row["previousObsDT"], row["latestObsDT"]]
@@ -112,7 +149,7 @@ def create_jump_plot(row, log_scale):
 @st.dialog("Change Row Data")
 def edit_data_form(selected_indices):
     edited_df = st.data_editor(
-        st.session_state.df_large_jumps.iloc[selected_indices],
+        st.session_state.df_large_jumps.loc[selected_indices],
         use_container_width=True,
         hide_index=True,
         disabled=(
@@ -143,12 +180,15 @@ def edit_data_form(selected_indices):
 
     if st.button("Submit", type="primary"):
         with st.spinner("Submitting changes..."):
-            for selected_index in selected_indices:
-                with get_cursor() as cursor:
-                    # Update SQL DB with the edited values
-                    row = edited_df.loc[selected_index]
-                    cursor.execute(
-                        UPDATE_LARGE_JUMPS_QUERY,
+            original_df = st.session_state.df_large_jumps.loc[edited_df.index]
+            # Only write the rows whose values were actually changed
+            changed_indices = get_changed_indices(original_df, edited_df, ["actionItem"])
+            if len(changed_indices):
+                # Queue the edited values and log entries, they are written to
+                # the SQL DB in the background
+                submit_changes(
+                    "large-jumps",
+                    [
                         {
                             "action_item": row["actionItem"],
                             "site_id": row["siteID"],
@@ -156,21 +196,18 @@ def edit_data_form(selected_indices):
                             "measure": row["measure"],
                             "previous_obs_dt": row["previousObsDT"],
                             "latest_obs_dt": row["latestObsDT"],
-                        },
-                    )
-                    # Update SQL DB with the log entry
-                    cursor.execute(
-                        INSERT_LOG_QUERY,
-                        get_log_entry(
-                            st.session_state.df_large_jumps.loc[selected_index],
-                            edited_df.loc[selected_index],
-                            "Large Jumps",
-                        ),
-                    )
-                # Update local DataFrame with the edited values
-                st.session_state.df_large_jumps.loc[selected_index, "actionItem"] = (
-                    edited_df.loc[selected_index, "actionItem"]
+                        }
+                        for _, row in edited_df.loc[changed_indices].iterrows()
+                    ],
+                    # One log entry per changed cell
+                    build_change_set(
+                        original_df, edited_df, "Large Jumps", ["actionItem"]
+                    ),
                 )
+            # Patch the shared cached dataframe so every session sees the edit
+            st.session_state.df_large_jumps.loc[changed_indices, "actionItem"] = (
+                edited_df.loc[changed_indices, "actionItem"]
+            )
 
             st.session_state.show_success_toast = True
             print("dialog triggered re-render")
@@ -179,88 +216,145 @@ def edit_data_form(selected_indices):
 
 def app():
     if "show_success_toast" in st.session_state and st.session_state.show_success_toast:
-        st.toast('Data successfully updated!', icon='✅')
+        st.toast('Changes submitted!', icon='✅')
         st.session_state.show_success_toast = False
-    
-    if "df_large_jumps" not in st.session_state:
-        with st.spinner(
-            "If the data cluster is cold starting, this may take up to 5 minutes",
-            show_time=True,
-        ):
-            with get_cursor() as cursor:
-                cursor.execute(FETCH_LARGE_JUMPS_QUERY)
-                rows = [row.asDict() for row in cursor.fetchall()]
-                st.session_state.df_large_jumps = pd.DataFrame(rows)
 
+    # Progress of the submitted changes being written to the SQL DB
+    show_write_queue_status("large-jumps")
+
+    # The dataset is cached once per process and shared across sessions
+    show_warehouse_status()
+    with st.spinner(
+        "If the data cluster is cold starting, this may take up to 5 minutes",
+        show_time=True,
+    ):
+        with timed_span("fetch"):
+            if SERVER_SIDE_FILTERS:
+                # Only the filter values are loaded here, the rows are filtered in SQL
+                sites = fetch_distinct_values(FETCH_LARGE_JUMPS_QUERY, "datasetID")
+                measures = fetch_distinct_values(FETCH_LARGE_JUMPS_QUERY, "measure")
+            else:
+                st.session_state.df_large_jumps = fetch_dataset(FETCH_LARGE_JUMPS_QUERY)
+                sites = st.session_state.df_large_jumps["datasetID"].unique()
+                measures = st.session_state.df_large_jumps["measure"].unique()
+    if not SERVER_SIDE_FILTERS:
+        show_refresh_button(FETCH_LARGE_JUMPS_QUERY)
+
+    jumps_table(sites, measures)
+
+
+@timed_fragment("table")
+def jumps_table(sites, measures):
+    # Filtering and selecting rows only rerun the table and plots
     # Filter the dataframe based on datasetID
-    sites = st.session_state.df_large_jumps["datasetID"].unique()
     selected_sites = st.multiselect(
         "Select datasetIDs to filter by:", sites, default=sites
     )
     # Filter the dataframe based on the selected measures
-    measures = st.session_state.df_large_jumps["measure"].unique()
     selected_measures = st.multiselect(
         "Select measures to filter by:", measures, default=measures
     )
     # Filter the dataframe based on the selected measures and datasetIDs
-    filtered_df = st.session_state.df_large_jumps[
-        st.session_state.df_large_jumps["measure"].isin(selected_measures)
-        & st.session_state.df_large_jumps["datasetID"].isin(selected_sites)
-    ]
+    with timed_span("filter"):
+        if SERVER_SIDE_FILTERS:
+            filtered_df = fetch_filtered_dataset(
+                FETCH_LARGE_JUMPS_QUERY,
+                {
+                    "datasetID": (
+                        None if set(selected_sites) == set(sites) else selected_sites
+                    ),
+                    "measure": (
+                        None
+                        if set(selected_measures) == set(measures)
+                        else selected_measures
+                    ),
+                },
+            )
+            # The edit dialog works on the rows shown in the table
+            st.session_state.df_large_jumps = filtered_df
+        else:
+            filtered_df = st.session_state.df_large_jumps[
+                st.session_state.df_large_jumps["measure"].isin(selected_measures)
+                & st.session_state.df_large_jumps["datasetID"].isin(selected_sites)
+            ]
 
-    selected_rows = st.dataframe(
-        filtered_df,
-        use_container_width=True,
-        hide_index=True,
-        selection_mode="multi-row" if USER_CAN_EDIT else None,
-        on_select="rerun" if USER_CAN_EDIT else "ignore",
-        column_config={
-            "latestObsDT": st.column_config.DatetimeColumn(
-                format="YYYY-MM-DD",
-            ),
-            "previousObsDT": st.column_config.DatetimeColumn(
-                format="YYYY-MM-DD",
-            ),
-        },
-    )
+    with timed_span("render table"):
+        selected_rows = st.dataframe(
+            filtered_df,
+            use_container_width=True,
+            hide_index=True,
+            selection_mode="multi-row" if USER_CAN_EDIT else None,
+            on_select="rerun" if USER_CAN_EDIT else "ignore",
+            column_config={
+                "latestObsDT": st.column_config.DatetimeColumn(
+                    format="YYYY-MM-DD",
+                ),
+                "previousObsDT": st.column_config.DatetimeColumn(
+                    format="YYYY-MM-DD",
+                ),
+            },
+        )
 
     # Get the index of the selected row, iff a row is selected
     if USER_CAN_EDIT and selected_rows.selection.get("rows", []):
-        if st.button("Edit Selected Row(s)", type="primary"):
-            edit_data_form(selected_rows.selection.rows)
-
-        # checkbox widget for toggling log scale of plots
-        log_scale = st.checkbox("Use log scale", value=True)
-        for idx in selected_rows.selection.rows:
-            row_data = filtered_df.iloc[idx]
-            fig = create_jump_plot(row_data, log_scale)
+        # Rows can only be edited once the live data has replaced a snapshot;
+        # server-side filtered rows always come from the warehouse
+        if st.button(
+            "Edit Selected Row(s)",
+            type="primary",
+            disabled=not (
+                SERVER_SIDE_FILTERS or is_dataset_live(FETCH_LARGE_JUMPS_QUERY)
+            ),
+        ):
+            start_submission("large-jumps")
+            edit_data_form(filtered_df.index[selected_rows.selection.rows])
+
+        selected_df = filtered_df.iloc[selected_rows.selection.rows]
+        with timed_span("fetch histories"):
+            histories = fetch_jump_histories(selected_df)
+        jump_plots(selected_df, histories)
+
+
+@timed_fragment("plots")
+def jump_plots(selected_df: pd.DataFrame, histories: dict[tuple, pd.DataFrame]):
+    # Toggling the log scale only reruns the plots, the histories are reused
+    # checkbox widget for toggling log scale of plots
+    log_scale = st.checkbox("Use log scale", value=True)
+    with timed_span("render plots"):
+        for _, row_data in selected_df.iterrows():
+            fig = create_jump_plot(
+                row_data, log_scale, histories[get_jump_key(row_data)]
+            )
             st.plotly_chart(fig, use_container_width=True)
 
 
-st.set_page_config(
-    page_title="Large Jumps",
-    page_icon="⚠️",
-    layout="wide",
-    initial_sidebar_state="expanded",
-)
+# Streamlit runs a page as __main__ (streamlit run) or __page__ (st.navigation);
+# importing it, e.g. from the tests, only defines its functions
+if __name__ in ("__main__", "__page__"):
+    st.set_page_config(
+        page_title="Large Jumps",
+        page_icon="⚠️",
+        layout="wide",
+        initial_sidebar_state="expanded",
+    )
 
-# hack to make the dialog box wider
-st.markdown(
-    """
-    <style>
-        div[data-testid="stDialog"] div[role="dialog"] {
-            width: 80%;
-        }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+    # hack to make the dialog box wider
+    st.markdown(
+        """
+        <style>
+            div[data-testid="stDialog"] div[role="dialog"] {
+                width: 80%;
+            }
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
 
-st.title("⚠️ Large Jumps")
-print("app re-render")
-app()
-st.markdown(
-    """
+    st.title("⚠️ Large Jumps")
+    print("app re-render")
+    app()
+    st.markdown(
+        """
         NOTE: `latestObsDT` shows when the latest **abnormal measure was observed**.
         This is **NOT** the latest observation date in the dataset for that site and measure.
         Refer to [Latest Measures](/latest-measures) for that information.
@@ -280,4 +374,4 @@ st.markdown(
         |                   |  • `newMax`: if `latestObs` is > historical maximum recorded for that site and measure          |
         | `actionItem`      | If this measure is supposed to be removed or kept (keep by default                              |
         """
-)
+    )
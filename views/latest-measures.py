@@ -1,54 +1,87 @@
-import pandas as pd
 import streamlit as st
 
-from utils import get_cursor, FETCH_LATEST_MEASURES_QUERY
+from utils import (
+    FETCH_LATEST_MEASURES_QUERY,
+    SERVER_SIDE_FILTERS,
+    fetch_dataset,
+    fetch_distinct_values,
+    fetch_filtered_dataset,
+    filter_sites_and_measures,
+    show_refresh_button,
+    show_warehouse_status,
+    timed_fragment,
+    timed_span,
+)
 
 
 def app():
-    if "df_latest_obs" not in st.session_state:
-        with st.spinner(
-            "If the data cluster is cold starting, this may take up to 5 minutes", show_time=True
-        ):
-            with get_cursor() as cursor:
-                cursor.execute(FETCH_LATEST_MEASURES_QUERY)
-                rows = [row.asDict() for row in cursor.fetchall()]
-                st.session_state.df_latest_obs = pd.DataFrame(rows)
+    # The dataset is cached once per process and shared across sessions
+    show_warehouse_status()
+    with st.spinner(
+        "If the data cluster is cold starting, this may take up to 5 minutes", show_time=True
+    ):
+        with timed_span("fetch"):
+            if SERVER_SIDE_FILTERS:
+                # Only the filter values are loaded here, the rows are filtered in SQL
+                sites = fetch_distinct_values(FETCH_LATEST_MEASURES_QUERY, "name")
+                measures = fetch_distinct_values(FETCH_LATEST_MEASURES_QUERY, "measure")
+            else:
+                st.session_state.df_latest_obs = fetch_dataset(
+                    FETCH_LATEST_MEASURES_QUERY
+                )
+                sites = st.session_state.df_latest_obs["name"].unique()
+                measures = st.session_state.df_latest_obs["measure"].unique()
+    if not SERVER_SIDE_FILTERS:
+        show_refresh_button(FETCH_LATEST_MEASURES_QUERY)
+
+    measures_table(sites, measures)
 
+
+@timed_fragment("table")
+def measures_table(sites, measures):
+    # Changing the filters only reruns the table
     # Filter the dataframe based on site names
-    sites = st.session_state.df_latest_obs["name"].unique()
     sites = ["All Sites"] + list(sites)
     selected_sites = st.multiselect(
         "Select sites to filter by:", sites, default=["All Sites"]
     )
     # Filter the dataframe based on the selected measures
-    measures = st.session_state.df_latest_obs["measure"].unique()
     selected_measures = st.multiselect(
         "Select measures to filter by:", measures, default=measures
     )
     # Filter the dataframe based on the selected measures and sites
-    if "All Sites" in selected_sites:
-        filtered_df = st.session_state.df_latest_obs[
-            st.session_state.df_latest_obs["measure"].isin(selected_measures)
-        ]
-    else:
-        filtered_df = st.session_state.df_latest_obs[
-            st.session_state.df_latest_obs["measure"].isin(selected_measures)
-            & st.session_state.df_latest_obs["name"].isin(selected_sites)
-        ]
+    with timed_span("filter"):
+        if SERVER_SIDE_FILTERS:
+            filtered_df = fetch_filtered_dataset(
+                FETCH_LATEST_MEASURES_QUERY,
+                {
+                    "name": None if "All Sites" in selected_sites else selected_sites,
+                    "measure": (
+                        None
+                        if set(selected_measures) == set(measures)
+                        else selected_measures
+                    ),
+                },
+            )
+        else:
+            filtered_df = filter_sites_and_measures(
+                st.session_state.df_latest_obs, "name", selected_sites, selected_measures
+            )
 
-    st.dataframe(
-        filtered_df,
-        use_container_width=True,
-        hide_index=True,
-        column_config={
-            "latestObsDT": st.column_config.DatetimeColumn(
-                format="YYYY-MM-DD",
-            ),
-            "previousObsDT": st.column_config.DatetimeColumn(
-                format="YYYY-MM-DD",
-            ),
-        },
-    )
+    with timed_span("render table"):
+        st.dataframe(
+            filtered_df,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "latestObsDT": st.column_config.DatetimeColumn(
+                    format="YYYY-MM-DD",
+                ),
+                "previousObsDT": st.column_config.DatetimeColumn(
+                    format="YYYY-MM-DD",
+                ),
+            },
+        )
 
 
 st.set_page_config(
@@ -3,13 +3,20 @@ import pandas as pd
 
 from utils import (
     FETCH_MPOX_QUERY,
-    UPDATE_MPOX_QUERY,
-    INSERT_LOG_QUERY,
+    build_change_set,
     can_user_edit,
-    get_cursor,
-    trigger_job_run,
-    get_log_entry,
+    fetch_dataset,
+    get_changed_indices,
+    is_dataset_live,
+    show_job_status,
+    show_refresh_button,
+    show_warehouse_status,
+    show_write_queue_status,
+    start_submission,
+    submit_changes,
     get_username,
+    timed_fragment,
+    timed_span,
 )
 
 
@@ -35,6 +42,7 @@ def edit_data_form(selected_indices):
                 required=True,
             ),
             "EpiYear": st.column_config.TextColumn(),
+            "Week_start": st.column_config.DateColumn(format="YYYY-MM-DD"),
         },
         use_container_width=True,
         hide_index=True,
@@ -46,42 +54,36 @@ def edit_data_form(selected_indices):
         "Submit", type="primary"
     ):
         with st.spinner('Submitting changes...'):
-            log_entries = []
-            for selected_index in selected_indices:
-                with get_cursor() as cursor:
-                    # Update SQL DB with the edited values
-                    row = edited_df.loc[selected_index]
-                    cursor.execute(
-                        UPDATE_MPOX_QUERY,
+            original_df = st.session_state.df_mpox.loc[edited_df.index]
+            # Only write the rows whose values were actually changed
+            changed_indices = get_changed_indices(
+                original_df, edited_df, ["g2r_label"]
+            )
+            # One log entry per changed cell
+            log_entries = build_change_set(
+                original_df, edited_df, "Mpox Trends", ["g2r_label"]
+            )
+            if log_entries:
+                # Queue the edited values and log entries, they are written to
+                # the SQL DB and published in the background
+                submit_changes(
+                    "mpox",
+                    [
                         {
                             "g2r_label": row["g2r_label"],
                             "location": row["Location"],
                             "epi_week": float(row["EpiWeek"]),
                             "epi_year": float(row["EpiYear"]),
-                            "week_start": row["Week_start"],
-                        },
-                    )
-                    # Update SQL DB with the log entry
-                    cursor.execute(
-                        INSERT_LOG_QUERY,
-                        get_log_entry(
-                            st.session_state.df_mpox.loc[selected_index],
-                            edited_df.loc[selected_index],
-                            "Mpox Trends",
-                        ),
-                    )
-                    log_entries.append(
-                        get_log_entry(
-                            st.session_state.df_mpox.loc[selected_index],
-                            edited_df.loc[selected_index],
-                            "Mpox Trends",
-                        )
-                    )
-                # Update local DataFrame with the edited values
-                st.session_state.df_mpox.loc[selected_index, "g2r_label"] = edited_df.loc[
-                    selected_index, "g2r_label"
-                ]
-            trigger_job_run("mpox", log_entries)
+                            "week_start": pd.Timestamp(row["Week_start"]).date(),
+                        }
+                        for _, row in edited_df.loc[changed_indices].iterrows()
+                    ],
+                    log_entries,
+                )
+            # Patch the shared cached dataframe so every session sees the edit
+            st.session_state.df_mpox.loc[changed_indices, "g2r_label"] = edited_df.loc[
+                changed_indices, "g2r_label"
+            ]
 
             st.session_state.show_success_toast = True
             print("dialog triggered re-render")
@@ -90,34 +92,53 @@ def edit_data_form(selected_indices):
 
 def app():
     if "show_success_toast" in st.session_state and st.session_state.show_success_toast:
-        st.toast('Data successfully updated!', icon='✅')
+        st.toast('Changes submitted!', icon='✅')
         st.session_state.show_success_toast = False
         
-    if "df_mpox" not in st.session_state:
-        with st.spinner(
-            "If the data cluster is cold starting, this may take up to 5 minutes",
-            show_time=True,
-        ):
-            with get_cursor() as cursor:
-                cursor.execute(FETCH_MPOX_QUERY)
-                rows = [row.asDict() for row in cursor.fetchall()]
-                st.session_state.df_mpox = pd.DataFrame(rows)
+    # Status of the latest publishing job, which runs in the background
+    show_job_status("mpox")
+    # Progress of the submitted changes being written to the SQL DB
+    show_write_queue_status("mpox")
+
+    # The dataset is cached once per process and shared across sessions
+    show_warehouse_status()
+    with st.spinner(
+        "If the data cluster is cold starting, this may take up to 5 minutes",
+        show_time=True,
+    ):
+        with timed_span("fetch"):
+            st.session_state.df_mpox = fetch_dataset(FETCH_MPOX_QUERY)
+    show_refresh_button(FETCH_MPOX_QUERY)
+
+    mpox_table()
 
+
+@timed_fragment("table")
+def mpox_table():
+    # Selecting rows only reruns the table
     # Create a dataframe where only a single-row is selectable
-    selected_rows = st.dataframe(
-        st.session_state.df_mpox,
-        use_container_width=True,
-        selection_mode="multi-row" if USER_CAN_EDIT else None,
-        on_select="rerun" if USER_CAN_EDIT else "ignore",
-        hide_index=True,
-        column_config={
-            "EpiYear": st.column_config.TextColumn(),
-        },
-    )
+    with timed_span("render table"):
+        selected_rows = st.dataframe(
+            st.session_state.df_mpox,
+            use_container_width=True,
+            selection_mode="multi-row" if USER_CAN_EDIT else None,
+            on_select="rerun" if USER_CAN_EDIT else "ignore",
+            hide_index=True,
+            column_config={
+                "EpiYear": st.column_config.TextColumn(),
+                "Week_start": st.column_config.DateColumn(format="YYYY-MM-DD"),
+            },
+        )
 
     # Get the index of the selected row, iff a row is selected
     if USER_CAN_EDIT and selected_rows.selection.get("rows", []):
-        if st.button("Edit Selected Row(s)", type="primary"):
+        # Rows can only be edited once the live data has replaced a snapshot
+        if st.button(
+            "Edit Selected Row(s)",
+            type="primary",
+            disabled=not is_dataset_live(FETCH_MPOX_QUERY),
+        ):
+            start_submission("mpox")
             edit_data_form(selected_rows.selection.rows)
 
 
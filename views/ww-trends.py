@@ -1,15 +1,26 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
 
 from utils import (
     FETCH_WW_TRENDS_QUERY,
-    INSERT_LOG_QUERY,
-    UPDATE_WW_TRENDS_QUERY,
+    build_change_set,
+    bump_dataset_version,
     can_user_edit,
-    get_cursor,
-    trigger_job_run,
-    get_log_entry,
+    fetch_dataset,
+    fetch_versioned_dataset,
+    filter_sites_and_measures,
+    get_changed_indices,
+    is_dataset_live,
+    show_job_status,
+    show_refresh_button,
+    show_warehouse_status,
+    show_write_queue_status,
+    start_submission,
+    submit_changes,
+    timed_fragment,
+    timed_span,
 )
 
 
@@ -38,6 +49,8 @@ prov_to_abbr = {
     "Yukon": "YT",
 }
 
+MEASURES = ["covN2", "rsv", "fluA", "fluB"]
+
 USER_CAN_EDIT = can_user_edit()
 
 
@@ -55,14 +68,9 @@ def get_missing_PT(df: pd.DataFrame, measure: str) -> bool:
     return missing
 
 
-def create_sunburst_graph(
-    df: pd.DataFrame, measure: str
-) -> tuple[px.sunburst, list[str]]:
+def build_sunburst_data(df: pd.DataFrame, measure: str) -> pd.DataFrame:
     df = df[df["measure"] == measure]
-
-    labels = []
-    parents = []
-    values = []
+    df = df[df["Grouping"].isin(["Site", "City", "Province", "Canada"])]
 
     site_only_mask = (
         # First find all Site rows
@@ -71,31 +79,35 @@ def create_sunburst_graph(
         # Then exclude locations that also have City records
         ~df["City"].isin(df[df["Grouping"] == "City"]["Location"].unique())
     )
+    is_site = (df["Grouping"] == "Site").to_numpy()
+    is_city = (df["Grouping"] == "City").to_numpy()
+    is_province = (df["Grouping"] == "Province").to_numpy()
+    province_abbr = df["Province"].map(prov_to_abbr).to_numpy()
+    city = df["City"].to_numpy()
+
+    labels = np.select(
+        [is_site, is_city, is_province],
+        [df["Location"].to_numpy(), city, province_abbr],
+        default="Canada",
+    )
+    parents = np.select(
+        [is_site & site_only_mask.to_numpy(), is_site, is_city, is_province],
+        [province_abbr, city, province_abbr, "Canada"],
+        default="",
+    )
 
-    for i, row in df.iterrows():
-        viral_activity = row["Viral_Activity_Level"]
-        if pd.isna(viral_activity):
-            print(f"Missing Viral_Activity_Level for {row['Location']}")
-            viral_activity = "NA1"
-
-        values.append(viral_activity)
-        if row["Grouping"] == "Site":
-            labels.append(row["Location"])
-            parent = prov_to_abbr[row["Province"]] if site_only_mask[i] else row["City"]
-            parents.append(parent)
-        if row["Grouping"] == "City":
-            labels.append(row["City"])
-            parents.append(prov_to_abbr[row["Province"]])
-        if row["Grouping"] == "Province":
-            labels.append(prov_to_abbr[row["Province"]])
-            parents.append("Canada")
-        if row["Grouping"] == "Canada":
-            labels.append("Canada")
-            parents.append("")
-
-    # Convert to a DataFrame
-    data = {"labels": labels, "parents": parents, "values": values}
-    data = pd.DataFrame(data)
+    missing_mask = df["Viral_Activity_Level"].isna()
+    for location in df.loc[missing_mask, "Location"]:
+        print(f"Missing Viral_Activity_Level for {location}")
+    values = df["Viral_Activity_Level"].where(~missing_mask, "NA1").to_numpy()
+
+    return pd.DataFrame({"labels": labels, "parents": parents, "values": values})
+
+
+def create_sunburst_graph(
+    df: pd.DataFrame, measure: str
+) -> tuple[px.sunburst, list[str]]:
+    data = build_sunburst_data(df, measure)
 
     fig = px.sunburst(
         data,
@@ -113,6 +125,26 @@ def create_sunburst_graph(
     return fig
 
 
+@st.cache_resource(max_entries=2, show_spinner=False)
+def get_sunburst_figures(
+    dataset_version: int, _df: pd.DataFrame
+) -> dict[str, tuple[set[str], px.sunburst]]:
+    # Precompute the missing PTs and the sunburst figure for every measure once
+    # per dataset version, shared across sessions. The figure is None when PTs
+    # are missing since the graph cannot be rendered. Figures are cached rather
+    # than their JSON: st.plotly_chart() only serializes a figure (about 1 ms,
+    # see tests/test_benchmarks.py), but would validate a dict into a new figure
+    # first, which costs about ten times as much.
+    figures = {}
+    for measure in MEASURES:
+        missing_PT = get_missing_PT(_df, measure)
+        figures[measure] = (
+            missing_PT,
+            None if missing_PT else create_sunburst_graph(_df, measure),
+        )
+    return figures
+
+
 @st.dialog("Change Row Data")
 def edit_data_form(selected_indices):
     columns = [
@@ -127,7 +159,7 @@ def edit_data_form(selected_indices):
     ]
 
     edited_df = st.data_editor(
-        st.session_state.df_ww.iloc[selected_indices],
+        st.session_state.df_ww.loc[selected_indices],
         column_order=columns,
         column_config={
             "Viral_Activity_Level": st.column_config.SelectboxColumn(
@@ -154,42 +186,42 @@ def edit_data_form(selected_indices):
         "Submit", type="primary"
     ):
         with st.spinner("Submitting changes..."):
-            log_entries = []
-            for selected_index in selected_indices:
-                with get_cursor() as cursor:
-                    # Update SQL DB with edited values
-                    row = edited_df.loc[selected_index]
-                    cursor.execute(
-                        UPDATE_WW_TRENDS_QUERY,
+            original_df = st.session_state.df_ww.loc[edited_df.index]
+            # Only write the rows whose values were actually changed
+            changed_indices = get_changed_indices(
+                original_df, edited_df, ["Viral_Activity_Level"]
+            )
+            # One log entry per changed cell
+            log_entries = build_change_set(
+                original_df,
+                edited_df,
+                "Water Wastewater Trends",
+                ["Viral_Activity_Level"],
+            )
+            if log_entries:
+                # Queue the edited values and log entries, they are written to
+                # the SQL DB and published in the background
+                submit_changes(
+                    "ww-trends",
+                    [
                         {
                             "viral_activity_level": row["Viral_Activity_Level"],
                             "location": row["Location"],
                             "measure": row["measure"],
                             "city": row["City"],
                             "province": row["Province"],
-                        },
-                    )
-                    # Update SQL DB with the log entry
-                    cursor.execute(
-                        INSERT_LOG_QUERY,
-                        get_log_entry(
-                            st.session_state.df_ww.loc[selected_index],
-                            edited_df.loc[selected_index],
-                            "Water Wastewater Trends",
-                        ),
-                    )
-                    log_entries.append(
-                        get_log_entry(
-                            st.session_state.df_ww.loc[selected_index],
-                            edited_df.loc[selected_index],
-                            "Water Wastewater Trends",
-                        )
-                    )
-                # Update the dataframe with the edited values
-                st.session_state.df_ww.loc[selected_index, "Viral_Activity_Level"] = (
-                    edited_df.loc[selected_index, "Viral_Activity_Level"]
+                        }
+                        for _, row in edited_df.loc[changed_indices].iterrows()
+                    ],
+                    log_entries,
                 )
-            trigger_job_run("ww-trends", log_entries)
+            # Patch the shared cached dataframe so every session sees the edit
+            st.session_state.df_ww.loc[changed_indices, "Viral_Activity_Level"] = (
+                edited_df.loc[changed_indices, "Viral_Activity_Level"]
+            )
+            if log_entries:
+                # Rebuild the precomputed sunburst figures on the next render
+                bump_dataset_version(FETCH_WW_TRENDS_QUERY)
 
             st.session_state.show_success_toast = True
             print("dialog triggered re-render")
@@ -198,37 +230,32 @@ def edit_data_form(selected_indices):
 
 def app():
     if "show_success_toast" in st.session_state and st.session_state.show_success_toast:
-        st.toast("Data successfully updated!", icon="✅")
+        st.toast("Changes submitted!", icon="✅")
         st.session_state.show_success_toast = False
 
-    if "df_ww" not in st.session_state:
-        with st.spinner(
-            "If the data cluster is cold starting, this may take up to 5 minutes",
-            show_time=True,
-        ):
-            with get_cursor() as cursor:
-                cursor.execute(FETCH_WW_TRENDS_QUERY)
-                rows = [row.asDict() for row in cursor.fetchall()]
-                st.session_state.df_ww = pd.DataFrame(rows)
+    # Status of the latest publishing job, which runs in the background
+    show_job_status("ww-trends")
+    # Progress of the submitted changes being written to the SQL DB
+    show_write_queue_status("ww-trends")
 
-    if "measure" not in st.session_state:
-        st.session_state.measure = "covN2"
+    # The dataset is cached once per process and shared across sessions
+    show_warehouse_status()
+    with st.spinner(
+        "If the data cluster is cold starting, this may take up to 5 minutes",
+        show_time=True,
+    ):
+        with timed_span("fetch"):
+            st.session_state.df_ww = fetch_dataset(FETCH_WW_TRENDS_QUERY)
+    show_refresh_button(FETCH_WW_TRENDS_QUERY)
 
-    left, right = st.columns([4, 1], vertical_alignment="center")
+    sunburst_chart()
+    sites_table()
 
-    missing_PT = get_missing_PT(st.session_state.df_ww, st.session_state.measure)
-    if missing_PT:
-        error_container = left.container()
-        for PT in missing_PT:
-            error_container.error(f"⛔ Missing data for **{PT}** PT in the dataset.")
-        error_container.warning(
-            f"The visualization requires data from all provinces to render the complete graph. Please add the missing PT data."
-        )
-    else:
-        left.plotly_chart(
-            create_sunburst_graph(st.session_state.df_ww, st.session_state.measure),
-            use_container_width=True,
-        )
+
+@timed_fragment("chart")
+def sunburst_chart():
+    # Switching the measure only reruns the chart
+    left, right = st.columns([4, 1], vertical_alignment="center")
 
     legend = pd.DataFrame(
         list(COLOR_MAP.items()), columns=["Viral Activity Level", "Color"]
@@ -246,16 +273,33 @@ def app():
         hide_index=True,
     )
 
-    selected = right.radio(
+    measure = right.radio(
         label="**Select measure:**",
-        options=["covN2", "rsv", "fluA", "fluB"],
+        options=MEASURES,
         key="measure_select",
     )
-    if selected != st.session_state.measure:
-        st.session_state.measure = selected
-        st.rerun()
 
-    # Filter the dataframe based on all sites
+    with timed_span("render sunburst"):
+        df, dataset_version = fetch_versioned_dataset(FETCH_WW_TRENDS_QUERY)
+        sunburst_figures = get_sunburst_figures(dataset_version, df)
+        missing_PT, sunburst_figure = sunburst_figures[measure]
+        if missing_PT:
+            error_container = left.container()
+            for PT in missing_PT:
+                error_container.error(f"⛔ Missing data for **{PT}** PT in the dataset.")
+            error_container.warning(
+                f"The visualization requires data from all provinces to render the complete graph. Please add the missing PT data."
+            )
+        else:
+            left.plotly_chart(
+                sunburst_figure,
+                use_container_width=True,
+            )
+
+
+@timed_fragment("table")
+def sites_table():
+    # Filtering and selecting rows only rerun the table, not the chart
     sites = st.session_state.df_ww["Location"].unique()
     sites = ["All Sites"] + list(sites)
     selected_sites = st.multiselect(
@@ -267,65 +311,70 @@ def app():
         "Select measures to filter by:", measures, default=measures
     )
     # Filter the dataframe based on the selected measures and sites
-    if "All Sites" in selected_sites:
-        filtered_df = st.session_state.df_ww[
-            st.session_state.df_ww["measure"].isin(selected_measures)
-        ]
-    else:
-        filtered_df = st.session_state.df_ww[
-            st.session_state.df_ww["measure"].isin(selected_measures)
-            & st.session_state.df_ww["Location"].isin(selected_sites)
-        ]
+    with timed_span("filter"):
+        filtered_df = filter_sites_and_measures(
+            st.session_state.df_ww, "Location", selected_sites, selected_measures
+        )
 
     # Create a dataframe where only a single-row is selectable
-    selected_rows = st.dataframe(
-        filtered_df,
-        use_container_width=True,
-        selection_mode="multi-row" if USER_CAN_EDIT else None,
-        on_select="rerun" if USER_CAN_EDIT else "ignore",
-        hide_index=True,
-        column_order=[
-            "Location",
-            "measure",
-            "latestTrends",
-            "LatestLevel",
-            "Grouping",
-            "City",
-            "Province",
-            "Viral_Activity_Level",
-        ],
-    )
+    with timed_span("render table"):
+        selected_rows = st.dataframe(
+            filtered_df,
+            use_container_width=True,
+            selection_mode="multi-row" if USER_CAN_EDIT else None,
+            on_select="rerun" if USER_CAN_EDIT else "ignore",
+            hide_index=True,
+            column_order=[
+                "Location",
+                "measure",
+                "latestTrends",
+                "LatestLevel",
+                "Grouping",
+                "City",
+                "Province",
+                "Viral_Activity_Level",
+            ],
+        )
 
     # Get the index of the selected row, iff a row is selected
     if USER_CAN_EDIT and selected_rows.selection.get("rows", []):
-        if st.button("Edit Selected Row(s)", type="primary"):
+        # Rows can only be edited once the live data has replaced a snapshot
+        if st.button(
+            "Edit Selected Row(s)",
+            type="primary",
+            disabled=not is_dataset_live(FETCH_WW_TRENDS_QUERY),
+        ):
+            start_submission("ww-trends")
             edit_data_form(filtered_df.index[selected_rows.selection.rows])
 
 
-st.set_page_config(
-    page_title="Respiratory Virus Trends",
-    page_icon="🚰",
-    layout="wide",
-    initial_sidebar_state="expanded",
-)
+# Streamlit runs a page as __main__ (streamlit run) or __page__ (st.navigation);
+# importing it, e.g. from the tests, only defines its functions
+if __name__ in ("__main__", "__page__"):
+    st.set_page_config(
+        page_title="Respiratory Virus Trends",
+        page_icon="🚰",
+        layout="wide",
+        initial_sidebar_state="expanded",
+    )
 
-# hack to make the dialog box wider
-st.markdown(
-    """
-    <style>
-        div[data-testid="stDialog"] div[role="dialog"] {
-            width: 80%;
-        }
-    </style>
-    """,
-    unsafe_allow_html=True,
-)
+    # hack to make the dialog box wider
+    st.markdown(
+        """
+        <style>
+            div[data-testid="stDialog"] div[role="dialog"] {
+                width: 80%;
+            }
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
 
-st.title("🚰 Respiratory Virus Trends")
-print("app re-render")
-app()
-st.markdown(
-    """
+    st.title("🚰 Respiratory Virus Trends")
+    print("app re-render")
+    app()
+    st.markdown(
+        """
 ## How to Use This App
 
 1. Use the selection box on the left of any row to select the site(s) you want to modify
@@ -336,4 +385,4 @@ st.markdown(
 
 For any questions or issues, please contact the system administrator.
 """
-)
+    )